@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import logging
+from dataclasses import dataclass, field
+from types import MappingProxyType
+
+
+def parse_user_ids(user_ids: str) -> list[int | None]:
+    """
+    Parses a comma-separated list of Telegram user IDs, keeping positions.
+    Entries that are not numeric IDs (e.g. '*', '-' or placeholders) become None.
+    """
+    parsed = []
+    for user_id in user_ids.split(','):
+        user_id = user_id.strip()
+        parsed.append(int(user_id) if user_id.lstrip('-').isdigit() else None)
+    return parsed
+
+
+@dataclass(frozen=True)
+class AccessPolicy:
+    """
+    Immutable access-control and budget index, built once from the bot configuration
+    so that authorization and budget lookups don't parse the configuration on every message.
+    Admin roles stored in the database are checked separately (see bd.is_admin).
+    """
+    allow_all: bool
+    allowed_user_ids: frozenset = field(default_factory=frozenset)
+    admin_user_ids: frozenset = field(default_factory=frozenset)
+    unlimited_budgets: bool = True
+    default_budget: float | None = None
+    budgets: MappingProxyType = field(default_factory=lambda: MappingProxyType({}))  # {user_id: budget}
+    group_member_ids: tuple = ()  # allowed users first, then admins, as checked for group chats
+
+    @classmethod
+    def from_config(cls, config: dict) -> AccessPolicy:
+        """
+        Builds the policy from the telegram configuration.
+        :param config: A dictionary containing the bot configuration
+        :return: The access policy
+        """
+        allow_all = config['allowed_user_ids'] == '*'
+        allowed_user_ids = parse_user_ids(config['allowed_user_ids'])
+        admin_user_ids = parse_user_ids(config['admin_user_ids']) if config['admin_user_ids'] != '-' else []
+
+        unlimited_budgets = config['user_budgets'] == '*'
+        user_budgets = config['user_budgets'].split(',')
+        default_budget = None
+        budgets = {}
+        if not unlimited_budgets:
+            if allow_all:
+                # same budget for all users, use value in first position of budget list
+                if len(user_budgets) > 1:
+                    logging.warning('multiple values for budgets set with unrestricted user list '
+                                    'only the first value is used as budget for everyone.')
+                default_budget = float(user_budgets[0])
+            else:
+                for index, user_id in enumerate(allowed_user_ids):
+                    if user_id is None or user_id in budgets:
+                        continue
+                    if len(user_budgets) <= index:
+                        logging.warning(f'No budget set for user id: {user_id}. Budget list shorter than user list.')
+                        budgets[user_id] = 0.0
+                    else:
+                        budgets[user_id] = float(user_budgets[index])
+
+        allowed = tuple(user_id for user_id in allowed_user_ids if user_id is not None)
+        admins = tuple(user_id for user_id in admin_user_ids if user_id is not None)
+        return cls(
+            allow_all=allow_all,
+            allowed_user_ids=frozenset(allowed),
+            admin_user_ids=frozenset(admins),
+            unlimited_budgets=unlimited_budgets,
+            default_budget=default_budget,
+            budgets=MappingProxyType(budgets),
+            group_member_ids=tuple(dict.fromkeys(allowed + admins)),
+        )
+
+    def is_allowed_user(self, user_id: int) -> bool:
+        """
+        Checks if the user is in the allowed user list (or everyone is allowed).
+        """
+        return self.allow_all or user_id in self.allowed_user_ids
+
+    def is_guest(self, user_id: int) -> bool:
+        """
+        Checks if the user's requests are also counted towards the guests' usage,
+        i.e. the user is not explicitly listed in the allowed user list.
+        """
+        return user_id not in self.allowed_user_ids
+
+    def budget_for(self, user_id: int) -> float | None:
+        """
+        Gets the configured budget of a non-admin user.
+        :param user_id: User id
+        :return: The user's budget, or None if the user is not found in the allowed user list
+        """
+        if self.unlimited_budgets:
+            return float('inf')
+        if self.allow_all:
+            return self.default_budget
+        return self.budgets.get(user_id)
@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+from collections import deque
+
+# Formats of Telegram audio attachments the Whisper API accepts as they are, by MIME type
+WHISPER_AUDIO_TYPES = {
+    'audio/ogg': 'ogg',
+    'audio/opus': 'ogg',
+    'audio/mpeg': 'mp3',
+    'audio/mp3': 'mp3',
+    'audio/mp4': 'm4a',
+    'audio/x-m4a': 'm4a',
+    'audio/m4a': 'm4a',
+    'audio/wav': 'wav',
+    'audio/x-wav': 'wav',
+    'audio/flac': 'flac',
+    'audio/x-flac': 'flac',
+    'audio/webm': 'webm',
+}
+
+# Largest file the Whisper API accepts
+WHISPER_MAX_FILE_SIZE = 25 * 1024 * 1024
+
+# Volume and minimum duration of a pause long media may be split at
+SILENCE_NOISE = '-30dB'
+SILENCE_MIN_DURATION = 0.5
+
+
+class TranscodingError(Exception):
+    """
+    Raised when ffmpeg or ffprobe fails to process a file.
+    """
+
+
+class AudioTranscoder:
+    """
+    Prepares audio and video files for the Whisper API with ffmpeg.
+    ffmpeg runs in subprocesses that stream from and to files, so neither the event loop
+    nor the bot's memory is used for decoding, and at most max_processes run at the same time.
+    """
+
+    def __init__(self, max_processes: int = 2):
+        """
+        :param max_processes: Maximum number of ffmpeg processes running at the same time
+        """
+        self.max_processes = max_processes
+        self._semaphore = None
+
+    async def _run(self, *args, stderr_filter: bytes = None) -> str:
+        """
+        Runs ffmpeg or ffprobe. The process is killed if the calling task is cancelled.
+        :param stderr_filter: If given, the lines of the standard error containing it are returned
+                              instead of the standard output. The standard error is read line by line,
+                              so other lines are not kept in memory
+        :return: The standard output of the process
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_processes)
+        async with self._semaphore:
+            process = await asyncio.create_subprocess_exec(
+                *args,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE if stderr_filter is None else asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE
+            )
+            try:
+                if stderr_filter is None:
+                    output, error = await process.communicate()
+                else:
+                    lines = []
+                    # the last lines are kept for the error message
+                    tail = deque(maxlen=10)
+                    async for line in process.stderr:
+                        if stderr_filter in line:
+                            lines.append(line)
+                        else:
+                            tail.append(line)
+                    await process.wait()
+                    output, error = b''.join(lines), b''.join(tail)
+            except asyncio.CancelledError:
+                process.kill()
+                await process.wait()
+                raise
+        if process.returncode != 0:
+            error = error.decode(errors='replace').strip()
+            raise TranscodingError(f'{args[0]} failed with exit code {process.returncode}: {error[-500:]}')
+        return output.decode(errors='replace')
+
+    async def probe_duration(self, filename: str) -> float:
+        """
+        Reads the duration of a media file from its metadata, without decoding it.
+        :param filename: The media file
+        :return: The duration in seconds
+        """
+        output = await self._run('ffprobe', '-v', 'error', '-show_entries', 'format=duration',
+                                 '-of', 'default=noprint_wrappers=1:nokey=1', filename)
+        try:
+            return float(output.strip())
+        except ValueError:
+            raise TranscodingError(f'ffprobe found no duration for {filename}')
+
+    async def prepare(self, filename: str, mime_type: str | None) -> str:
+        """
+        Gets a file of the media the Whisper API accepts. Audio in a format Whisper supports,
+        such as voice notes, is only renamed with the extension of its format, anything else
+        has its audio track transcoded to mp3.
+        :param filename: The downloaded media file
+        :param mime_type: The MIME type of the media, if known
+        :return: The file to transcribe, it replaces the downloaded file if that was renamed
+        """
+        extension = WHISPER_AUDIO_TYPES.get(mime_type)
+        if extension is not None and os.path.getsize(filename) <= WHISPER_MAX_FILE_SIZE:
+            target = f'{filename}.{extension}'
+            os.replace(filename, target)
+            return target
+
+        target = f'{filename}.mp3'
+        logging.info(f'Transcoding {filename} ({mime_type}) to mp3...')
+        try:
+            await self._run('ffmpeg', '-nostdin', '-v', 'error', '-y', '-i', filename,
+                            '-map', '0:a:0', '-vn', '-ac', '1', '-c:a', 'libmp3lame', '-b:a', '64k', target)
+        except Exception:
+            if os.path.exists(target):
+                os.remove(target)
+            raise
+        return target
+
+    async def detect_silences(self, filename: str) -> list[tuple[float, float]]:
+        """
+        Finds the pauses in the audio of a media file.
+        :param filename: The media file
+        :return: The start and end times of the pauses in seconds
+        """
+        output = await self._run('ffmpeg', '-nostdin', '-hide_banner', '-nostats', '-v', 'info',
+                                 '-i', filename, '-map', '0:a:0',
+                                 '-af', f'silencedetect=noise={SILENCE_NOISE}:d={SILENCE_MIN_DURATION}',
+                                 '-f', 'null', '-', stderr_filter=b'silencedetect')
+        silences = []
+        silence_start = None
+        for line in output.splitlines():
+            if 'silence_start:' in line:
+                silence_start = float(line.split('silence_start:')[1].split()[0])
+            elif 'silence_end:' in line and silence_start is not None:
+                silence_end = float(line.split('silence_end:')[1].split()[0])
+                silences.append((silence_start, silence_end))
+                silence_start = None
+        return silences
+
+    @staticmethod
+    def choose_split_points(silences: list[tuple[float, float]], duration: float, chunk_seconds: float) -> list[float]:
+        """
+        Chooses where to split media into chunks of at most chunk_seconds: in the middle of the last pause
+        in the second half of each chunk, or at its end if there is none.
+        :param silences: The start and end times of the pauses
+        :param duration: The duration of the media
+        :param chunk_seconds: The maximum duration of a chunk
+        :return: The split points in seconds
+        """
+        pauses = [(start + end) / 2 for start, end in silences]
+        points = []
+        chunk_start = 0.0
+        while duration - chunk_start > chunk_seconds:
+            chunk_end = chunk_start + chunk_seconds
+            candidates = [pause for pause in pauses if chunk_start + chunk_seconds / 2 <= pause <= chunk_end]
+            chunk_start = candidates[-1] if candidates else chunk_end
+            points.append(chunk_start)
+        return points
+
+    async def split(self, filename: str, duration: float, chunk_seconds: float, directory: str) -> list[str]:
+        """
+        Splits the audio of a media file at pauses into mp3 segments of at most chunk_seconds.
+        :param filename: The media file
+        :param duration: The duration of the media
+        :param chunk_seconds: The maximum duration of a segment
+        :param directory: The directory to write the segments to
+        :return: The segment files, in order
+        """
+        silences = await self.detect_silences(filename)
+        points = self.choose_split_points(silences, duration, chunk_seconds)
+        logging.info(f'Splitting {filename} into {len(points) + 1} segments...')
+        os.makedirs(directory, exist_ok=True)
+        args = ['ffmpeg', '-nostdin', '-v', 'error', '-y', '-i', filename,
+                '-map', '0:a:0', '-vn', '-ac', '1', '-c:a', 'libmp3lame', '-b:a', '64k']
+        if points:
+            args += ['-f', 'segment', '-segment_times', ','.join(f'{point:.3f}' for point in points),
+                     '-reset_timestamps', '1', os.path.join(directory, 'segment_%03d.mp3')]
+        else:
+            args += [os.path.join(directory, 'segment_000.mp3')]
+        await self._run(*args)
+        return sorted(os.path.join(directory, name) for name in os.listdir(directory))
@@ -1,16 +1,173 @@
+import asyncio
+import atexit
+import functools
 import os
+import threading
+import time
 import psycopg2
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from psycopg2.extras import Json
+from psycopg2.extras import Json, execute_values
+from psycopg2.pool import PoolError
 
 # Получение секретного URL базы данных из переменной окружения
 my_secret = os.environ['DATABASE_URL']
+# Режим SSL для соединений (для локального PostgreSQL можно указать disable)
+DATABASE_SSLMODE = os.environ.get('DATABASE_SSLMODE', 'require')
+
+
+class ConnectionPool:
+    """
+    Пул соединений с PostgreSQL на уровне процесса.
+    Держит от min_size до max_size соединений, проверяет соединение перед выдачей,
+    если оно простаивало дольше health_check_interval секунд,
+    и пересоздаёт соединения, простаивавшие дольше max_idle секунд.
+    """
+
+    def __init__(self, dsn, min_size=1, max_size=10, max_idle=300.0, health_check_interval=30.0,
+                 timeout=10.0, **connect_kwargs):
+        """
+        :param dsn: URL базы данных
+        :param min_size: Минимальное количество открытых соединений
+        :param max_size: Максимальное количество одновременно выданных соединений
+        :param max_idle: Время простоя в секундах, после которого соединение закрывается
+        :param health_check_interval: Время простоя в секундах, после которого соединение проверяется перед выдачей
+        :param timeout: Время ожидания свободного соединения в секундах
+        :param connect_kwargs: Дополнительные параметры для psycopg2.connect
+        """
+        self.dsn = dsn
+        self.connect_kwargs = connect_kwargs
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.health_check_interval = health_check_interval
+        self.timeout = timeout
+        self._idle = []  # [(connection, last_used)], последним идёт самое свежее соединение
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._closed = False
+        for _ in range(min_size):
+            self._idle.append((self._connect(), time.monotonic()))
+
+    def _connect(self):
+        return psycopg2.connect(self.dsn, **self.connect_kwargs)
+
+    @staticmethod
+    def _discard(connection):
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+    @staticmethod
+    def _is_healthy(connection) -> bool:
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        """Выдаёт соединение из пула, при необходимости открывая новое."""
+        if self._closed:
+            raise PoolError("пул соединений закрыт")
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolError(f"нет свободных соединений в пуле за {self.timeout} с")
+        try:
+            while True:
+                with self._lock:
+                    item = self._idle.pop() if self._idle else None
+                if item is None:
+                    return self._connect()
+                connection, last_used = item
+                idle_for = time.monotonic() - last_used
+                if connection.closed or idle_for > self.max_idle:
+                    self._discard(connection)
+                    continue
+                if idle_for > self.health_check_interval and not self._is_healthy(connection):
+                    self._discard(connection)
+                    continue
+                return connection
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def putconn(self, connection, discard=False):
+        """Возвращает соединение в пул, откатывая незавершённую транзакцию."""
+        try:
+            if not discard and not self._closed and not connection.closed:
+                try:
+                    connection.rollback()
+                except psycopg2.Error:
+                    discard = True
+            if discard or self._closed or connection.closed:
+                self._discard(connection)
+                return
+            now = time.monotonic()
+            with self._lock:
+                self._idle.append((connection, now))
+                # Закрываем соединения сверх min_size, которые простаивали слишком долго
+                expired = [item for item in self._idle[:-self.min_size or None] if now - item[1] > self.max_idle]
+                if expired:
+                    self._idle = [item for item in self._idle if item not in expired]
+            for stale_connection, _ in expired:
+                self._discard(stale_connection)
+        finally:
+            self._slots.release()
+
+    def closeall(self):
+        """Закрывает все свободные соединения и запрещает выдачу новых."""
+        self._closed = True
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            self._discard(connection)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """Возвращает пул соединений процесса, создавая его при первом обращении."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    my_secret,
+                    min_size=int(os.environ.get('DB_POOL_MIN_SIZE', 1)),
+                    max_size=int(os.environ.get('DB_POOL_MAX_SIZE', 10)),
+                    max_idle=float(os.environ.get('DB_POOL_MAX_IDLE_SECONDS', 300)),
+                    health_check_interval=float(os.environ.get('DB_POOL_HEALTH_CHECK_SECONDS', 30)),
+                    timeout=float(os.environ.get('DB_POOL_TIMEOUT_SECONDS', 10)),
+                    sslmode=DATABASE_SSLMODE,
+                )
+                atexit.register(_pool.closeall)
+    return _pool
+
+
+# Ограниченный пул потоков для обращений к базе данных из асинхронных обработчиков
+_db_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('DB_POOL_MAX_SIZE', 10)),
+                                  thread_name_prefix='db')
+# Запись статистики идёт в одном потоке, чтобы записи одного пользователя не переупорядочивались
+_db_write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-write')
+
+
+async def run_in_db_executor(func, *args, **kwargs):
+    """Выполняет синхронную функцию работы с базой данных, не блокируя цикл событий."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, functools.partial(func, *args, **kwargs))
+
 
 # Контекстный менеджер для работы с базой данных
 class DatabaseConnection:
     def __enter__(self):
+        self.connection = None
         try:
-            self.connection = psycopg2.connect(my_secret, sslmode='require')
+            self.connection = get_pool().getconn()
             return self.connection
         except psycopg2.Error as error:
             print("Ошибка при подключении к PostgreSQL:", error)
@@ -18,7 +175,9 @@ class DatabaseConnection:
 
     def __exit__(self, exc_type, exc_value, traceback):
         if self.connection is not None:
-            self.connection.close()
+            # Разорванное соединение не возвращаем в пул
+            broken = isinstance(exc_value, (psycopg2.OperationalError, psycopg2.InterfaceError))
+            get_pool().putconn(self.connection, discard=broken)
 
 # Функция для проверки существования и создания таблицы пользователей
 def check_and_create_database():
@@ -164,7 +323,167 @@ def add_user(telegram_id: int, user_name: str, first_name: str, last_name: str,
     except psycopg2.Error as error:
         print("Ошибка при добавлении пользователя в базу данных:", error)
 
+def get_known_user_ids() -> set:
+    """Возвращает множество telegram_id всех пользователей из таблицы chat_users."""
+    try:
+        with DatabaseConnection() as connection:
+            if connection is not None:
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT telegram_id FROM chat_users")
+                    return {row[0] for row in cursor}
+            else:
+                print("Ошибка: соединение с базой данных не установлено")
+    except psycopg2.Error as error:
+        print("Ошибка при загрузке пользователей из базы данных:", error)
+    return set()
+
+
+# Функция пакетного добавления пользователей
+def add_users(users) -> bool:
+    """
+    Добавляет пользователей одним запросом, пропуская уже существующих.
+    :param users: Кортежи (telegram_id, user_name, first_name, last_name, user_type, created_at)
+    :return: True, если транзакция зафиксирована
+    """
+    try:
+        with DatabaseConnection() as connection:
+            if connection is not None:
+                with connection.cursor() as cursor:
+                    inserted = execute_values(cursor, """
+                        INSERT INTO chat_users (telegram_id, user_name, first_name, last_name, user_type, created_at)
+                        VALUES %s
+                        ON CONFLICT (telegram_id) DO NOTHING
+                        RETURNING telegram_id
+                    """, users, fetch=True)
+                connection.commit()
+                if inserted:
+                    print(f"Новых пользователей добавлено в базу данных: {len(inserted)}")
+                return True
+            else:
+                print("Ошибка: соединение с базой данных не установлено")
+    except psycopg2.Error as error:
+        print("Ошибка при добавлении пользователей в базу данных:", error)
+    return False
+
+
+class KnownUsers:
+    """
+    Кэш известных пользователей перед add_user.
+    Пользователи, которые уже есть в базе данных, не вызывают обращений к ней,
+    а новые ставятся в очередь и добавляются пачками фоновой задачей.
+    """
+
+    def __init__(self):
+        self.ids = set()
+        self._pending = {}  # {telegram_id: строка для add_users}
+        self._task = None
+        self._stop_event = None
+
+    async def start(self, interval=2.0):
+        """
+        Загружает известных пользователей и запускает фоновое добавление новых.
+        :param interval: Интервал между пакетными вставками в секундах
+        """
+        self.ids |= await run_in_db_executor(get_known_user_ids)
+        self._stop_event = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run(interval))
+
+    async def stop(self):
+        """Останавливает фоновое добавление и добавляет оставшихся в очереди пользователей."""
+        if self._task is not None:
+            task, self._task = self._task, None
+            # задача не отменяется, чтобы не потерять пачку, которая уже добавляется
+            self._stop_event.set()
+            await task
+        await self.flush()
+
+    def add(self, telegram_id: int, user_name: str, first_name: str, last_name: str, user_type: str = "guest"):
+        """Ставит пользователя в очередь на добавление, если он ещё не известен."""
+        if telegram_id in self.ids:
+            return
+        self.ids.add(telegram_id)
+        self._pending[telegram_id] = (telegram_id, user_name, first_name, last_name, user_type, datetime.now())
+
+    async def _run(self, interval):
+        while not self._stop_event.is_set():
+            try:
+                await asyncio.wait_for(self._stop_event.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def flush(self):
+        """Добавляет накопленных пользователей одним запросом."""
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        if not await run_in_db_executor(add_users, list(pending.values())):
+            # вернём пользователей в очередь до следующей попытки
+            for telegram_id, row in pending.items():
+                self._pending.setdefault(telegram_id, row)
+
+
+# Известные пользователи процесса
+known_users = KnownUsers()
+
+
+class RoleCache:
+    """
+    Кэш результатов is_admin по telegram_id с ограниченным временем жизни записей.
+    Считает попадания и промахи, чтобы было видно, сколько запросов к базе он убирает.
+    """
+
+    def __init__(self, ttl=30.0):
+        """
+        :param ttl: Время жизни записи в секундах, за которое изменение роли в базе дойдёт до бота
+        """
+        self.ttl = ttl
+        self._entries = {}  # {telegram_id: (expires_at, результат is_admin)}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, telegram_id):
+        """Возвращает закэшированный результат is_admin или None."""
+        with self._lock:
+            entry = self._entries.get(telegram_id)
+            if entry is not None and entry[0] > time.monotonic():
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, telegram_id, result):
+        with self._lock:
+            self._entries[telegram_id] = (time.monotonic() + self.ttl, result)
+
+    def invalidate(self, telegram_id=None):
+        """Сбрасывает запись пользователя или, если telegram_id не указан, весь кэш."""
+        with self._lock:
+            if telegram_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(telegram_id, None)
+
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+# Кэш ролей пользователей процесса
+role_cache = RoleCache(ttl=float(os.environ.get('ROLE_CACHE_TTL_SECONDS', 30)))
+
+
 def is_admin(user_id: int) -> tuple:
+    """Проверяет, является ли пользователь администратором, сначала по кэшу ролей."""
+    cached = role_cache.get(user_id)
+    if cached is not None:
+        return cached
+    return fetch_admin_role(user_id)
+
+
+def fetch_admin_role(user_id: int) -> tuple:
+    """Запрашивает роль пользователя в базе данных в обход кэша и обновляет кэш."""
     try:
         admins = []
         # Подключение к базе данных с использованием вашего контекстного менеджера
@@ -180,10 +499,10 @@ def is_admin(user_id: int) -> tuple:
                         if user_type == 'admin':
                             admins.append(telegram_id)
 
-                    if len(admins) > 0:
-                        return True, admins
-                    else:
-                        return False, []
+                    result = (True, admins) if len(admins) > 0 else (False, [])
+                    # ошибки не кэшируем, чтобы при восстановлении базы роль перечиталась сразу
+                    role_cache.put(user_id, result)
+                    return result
             else:
                 print("Ошибка: соединение с базой данных не установлено")
     except psycopg2.Error as error:
@@ -192,114 +511,237 @@ def is_admin(user_id: int) -> tuple:
 
     return False, []
 
-# Функция для сохранения данных использования в базу данных
-def save_to_database(user_id, usage_data):
+# Многострочный запрос сохранения текущих затрат
+CURRENT_COST_UPSERT = """
+    INSERT INTO current_cost (user_id, day_cost, month_cost, all_time_cost, last_update)
+    VALUES %s
+    ON CONFLICT (user_id) DO UPDATE SET
+    day_cost = EXCLUDED.day_cost,
+    month_cost = EXCLUDED.month_cost,
+    all_time_cost = EXCLUDED.all_time_cost,
+    last_update = EXCLUDED.last_update
+"""
+
+# Многострочные запросы сохранения истории использования: метрика -> запрос для таблицы истории
+HISTORY_UPSERTS = {
+    "chat_tokens": """
+        INSERT INTO chat_tokens_history (user_id, date, tokens_used)
+        VALUES %s
+        ON CONFLICT (user_id, date) DO UPDATE SET
+        tokens_used = EXCLUDED.tokens_used
+    """,
+    "transcription_seconds": """
+        INSERT INTO transcription_seconds_history (user_id, date, seconds_used)
+        VALUES %s
+        ON CONFLICT (user_id, date) DO UPDATE SET
+        seconds_used = EXCLUDED.seconds_used
+    """,
+    "number_images": """
+        INSERT INTO number_images_history (user_id, date, image_data)
+        VALUES %s
+        ON CONFLICT (user_id, date) DO UPDATE SET
+        image_data = EXCLUDED.image_data
+    """,
+}
+
+
+def build_usage_rows(user_id, usage_data, dirty_cells=None):
+    """
+    Готовит строки для сохранения данных использования.
+    :param user_id: ID пользователя в Telegram
+    :param usage_data: Данные использования в формате UsageTracker
+    :param dirty_cells: Изменённые ячейки истории в виде пар (метрика, дата), None - вся история
+    :return: Строка для current_cost и словарь строк истории по метрикам
+    """
+    current_cost = usage_data["current_cost"]
+    cost_row = (
+        user_id,
+        current_cost["day"],
+        current_cost["month"],
+        current_cost["all_time"],
+        current_cost["last_update"]
+    )
+
+    history = usage_data["usage_history"]
+    if dirty_cells is None:
+        dirty_cells = [(metric, date) for metric in HISTORY_UPSERTS for date in history[metric]]
+
+    history_rows = {metric: [] for metric in HISTORY_UPSERTS}
+    for metric, date in dirty_cells:
+        if metric not in history_rows or date not in history[metric]:
+            continue
+        value = history[metric][date]
+        if metric == "number_images":
+            # копия списка, чтобы последующие запросы изображений не изменили подготовленную строку
+            value = Json(list(value))
+        history_rows[metric].append((user_id, date, value))
+    return cost_row, history_rows
+
+
+def save_usage_batch(cost_rows, history_rows) -> bool:
+    """
+    Сохраняет строки использования любого числа пользователей одной транзакцией
+    многострочными upsert-запросами.
+    :param cost_rows: Строки для таблицы current_cost
+    :param history_rows: Словарь строк истории по метрикам
+    :return: True, если транзакция зафиксирована
+    """
     try:
         with DatabaseConnection() as connection:
             if connection is not None:
                 with connection.cursor() as cursor:
-                    # Сохраняем данные в таблицу current_cost
-                    cursor.execute("""
-                        INSERT INTO current_cost (user_id, day_cost, month_cost, all_time_cost, last_update)
-                        VALUES (%s, %s, %s, %s, %s)
-                        ON CONFLICT (user_id) DO UPDATE SET
-                        day_cost = EXCLUDED.day_cost,
-                        month_cost = EXCLUDED.month_cost,
-                        all_time_cost = EXCLUDED.all_time_cost,
-                        last_update = EXCLUDED.last_update
-                    """, (
-                        user_id,
-                        usage_data["current_cost"]["day"],
-                        usage_data["current_cost"]["month"],
-                        usage_data["current_cost"]["all_time"],
-                        usage_data["current_cost"]["last_update"]
-                    ))
-
-                    # Сохраняем данные из usage_history в соответствующие таблицы
-
-                    # Сохраняем данные из usage_history["chat_tokens"] в таблицу chat_tokens_history
-                    for date, tokens_used in usage_data["usage_history"]["chat_tokens"].items():
-                        try:
-                            cursor.execute("""
-                                INSERT INTO chat_tokens_history (user_id, date, tokens_used)
-                                VALUES (%s, %s, %s)
-                                ON CONFLICT (user_id, date) DO UPDATE SET
-                                tokens_used = EXCLUDED.tokens_used
-                            """, (
-                                user_id,
-                                date,
-                                tokens_used
-                            ))
-                            # print("Данные успешно сохранены в таблице chat_tokens_history!")
-                        except psycopg2.Error as chat_tokens_error:
-                            print("Ошибка при сохранении в таблице chat_tokens_history:", chat_tokens_error)
-
-                    # Сохраняем данные из usage_history["transcription_seconds"] в таблицу transcription_seconds_history
-                    for date, seconds_used in usage_data["usage_history"]["transcription_seconds"].items():
-                        try:
-                            cursor.execute("""
-                                INSERT INTO transcription_seconds_history (user_id, date, seconds_used)
-                                VALUES (%s, %s, %s)
-                                ON CONFLICT (user_id, date) DO UPDATE SET
-                                seconds_used = EXCLUDED.seconds_used
-                            """, (
-                                user_id,
-                                date,
-                                seconds_used
-                            ))
-                            # print("Данные успешно сохранены в таблице transcription_seconds_history!")
-                        except psycopg2.Error as transcription_seconds_error:
-                            print("Ошибка при сохранении в таблице transcription_seconds_history:", transcription_seconds_error)
-
-                    # Сохраняем данные из usage_history["number_images"] в таблицу number_images_history
-                    for date, image_data in usage_data["usage_history"]["number_images"].items():
-                        try:
-                            cursor.execute("""
-                                INSERT INTO number_images_history (user_id, date, image_data)
-                                VALUES (%s, %s, %s)
-                                ON CONFLICT (user_id, date) DO UPDATE SET
-                                image_data = EXCLUDED.image_data
-                            """, (
-                                user_id,
-                                date,
-                                Json(image_data)
-                            ))
-                            # print("Данные успешно сохранены в таблице number_images_history!")
-                        except psycopg2.Error as number_images_error:
-                            print("Ошибка при сохранении в таблице number_images_history:", number_images_error)
-
-                    connection.commit()
+                    # current_cost сохраняем первой: на неё ссылаются таблицы истории
+                    if cost_rows:
+                        execute_values(cursor, CURRENT_COST_UPSERT, cost_rows)
+                    for metric, rows in history_rows.items():
+                        if rows:
+                            execute_values(cursor, HISTORY_UPSERTS[metric], rows)
+                connection.commit()
+                return True
             else:
                 print("Ошибка: соединение с базой данных не установлено")
     except psycopg2.Error as error:
         print("Общая ошибка при сохранении в базе данных:", error)
+    return False
 
-# Функция для получения данных использования из бд
-def get_user_usage(user_id):
+
+def save_usage_rows(cost_row, history_rows) -> bool:
+    """Сохраняет подготовленные строки использования одного пользователя одной транзакцией."""
+    return save_usage_batch([cost_row], history_rows)
+
+
+# Функция для сохранения данных использования в базу данных
+def save_to_database(user_id, usage_data, dirty_cells=None):
+    """
+    Сохраняет current_cost и изменённые ячейки истории пользователя.
+    :param dirty_cells: Изменённые ячейки истории в виде пар (метрика, дата), None - вся история
+    """
+    save_usage_rows(*build_usage_rows(user_id, usage_data, dirty_cells))
+
+# Столбец с документом использования пользователя, собранным целиком на стороне базы
+USAGE_DOCUMENT_COLUMN = """
+    json_build_object(
+        'current_cost', json_build_object(
+            'day', c.day_cost,
+            'month', c.month_cost,
+            'all_time', c.all_time_cost,
+            'last_update', to_char(c.last_update, 'YYYY-MM-DD')
+        ),
+        'usage_history', json_build_object(
+            'chat_tokens', COALESCE(
+                (SELECT json_object_agg(to_char(h.date, 'YYYY-MM-DD'), h.tokens_used)
+                 FROM chat_tokens_history h WHERE h.user_id = c.user_id), '{}'::json),
+            'transcription_seconds', COALESCE(
+                (SELECT json_object_agg(to_char(h.date, 'YYYY-MM-DD'), h.seconds_used)
+                 FROM transcription_seconds_history h WHERE h.user_id = c.user_id), '{}'::json),
+            'number_images', COALESCE(
+                (SELECT json_object_agg(to_char(h.date, 'YYYY-MM-DD'), h.image_data)
+                 FROM number_images_history h WHERE h.user_id = c.user_id), '{}'::json)
+        )
+    )
+"""
+
+# Документы использования выбранных пользователей за одно обращение к базе
+USERS_USAGE_QUERY = """
+    SELECT c.user_id, """ + USAGE_DOCUMENT_COLUMN + """
+    FROM current_cost c
+    WHERE c.user_id = ANY(%s)
+"""
+
+# Документы использования пользователей, активных за последние N дней, с именем пользователя
+ACTIVE_USERS_USAGE_QUERY = """
+    SELECT c.user_id,
+           COALESCE('@' || u.user_name, concat_ws(' ', u.first_name, u.last_name)),
+           """ + USAGE_DOCUMENT_COLUMN + """
+    FROM current_cost c
+    LEFT JOIN chat_users u ON u.telegram_id = c.user_id
+    WHERE c.last_update >= CURRENT_DATE - %s
+"""
+
+
+# Функция для получения данных использования многих пользователей из бд
+def get_users_usage(user_ids) -> dict:
+    """
+    Загружает данные использования нескольких пользователей одним запросом.
+    :param user_ids: ID пользователей в Telegram
+    :return: Словарь {user_id: {"current_cost": {...}, "usage_history": {...}}},
+             пользователей без данных в нём нет
+    """
+    # трекер гостей в базе данных не хранится
+    user_ids = [user_id for user_id in user_ids if isinstance(user_id, int)]
+    if not user_ids:
+        return {}
     try:
         with DatabaseConnection() as connection:
             if connection is not None:
                 with connection.cursor() as cursor:
-                    # Получаем данные пользователя из таблицы current_cost
-                    cursor.execute("SELECT * FROM current_cost WHERE user_id = %s", (user_id,))
-                    current_cost = cursor.fetchone()
+                    cursor.execute(USERS_USAGE_QUERY, (user_ids,))
+                    return dict(cursor.fetchall())
+            else:
+                print("Ошибка: соединение с базой данных не установлено")
+    except psycopg2.Error as error:
+        print("Ошибка при подключении к базе данных:", error)
+    return {}
 
-                    # Получаем данные из таблицы chat_tokens_history
-                    cursor.execute("SELECT * FROM chat_tokens_history WHERE user_id = %s", (user_id,))
-                    chat_tokens_history = cursor.fetchall()
 
-                    # Получаем данные из таблицы transcription_seconds_history
-                    cursor.execute("SELECT * FROM transcription_seconds_history WHERE user_id = %s", (user_id,))
-                    transcription_seconds_history = cursor.fetchall()
+# Функция для получения данных использования из бд
+def get_user_usage(user_id):
+    """
+    Загружает данные использования пользователя одним запросом.
+    :return: Документ {"current_cost": {...}, "usage_history": {...}} или None
+    """
+    return get_users_usage([user_id]).get(user_id)
 
-                    # Получаем данные из таблицы number_images_history
-                    cursor.execute("SELECT * FROM number_images_history WHERE user_id = %s", (user_id,))
-                    number_images_history = cursor.fetchall()
 
-                    return current_cost, chat_tokens_history, transcription_seconds_history, number_images_history
+def iter_active_users_usage(days: int, batch_size: int = 500):
+    """
+    Построчно выдаёт данные использования пользователей, активных за последние days дней.
+    Результат читается серверным курсором порциями по batch_size строк, а не целиком в память.
+    :return: Генератор кортежей (user_id, user_name, документ использования)
+    """
+    try:
+        with DatabaseConnection() as connection:
+            if connection is not None:
+                with connection.cursor(name='active_users_usage') as cursor:
+                    cursor.itersize = batch_size
+                    cursor.execute(ACTIVE_USERS_USAGE_QUERY, (days,))
+                    for row in cursor:
+                        yield row
             else:
                 print("Ошибка: соединение с базой данных не установлено")
-                return None
     except psycopg2.Error as error:
-        print("Ошибка при подключении к базе данных:", error)
-        return None  
\ No newline at end of file
+        print("Ошибка при загрузке данных использования активных пользователей:", error)
+
+
+def save_to_database_in_background(user_id, usage_data, dirty_cells=None):
+    """
+    Ставит сохранение данных использования в очередь записи и сразу возвращает управление.
+    Строки готовятся сразу, чтобы последующие изменения не попали в уже поставленную запись.
+    """
+    return _db_write_executor.submit(save_usage_rows, *build_usage_rows(user_id, usage_data, dirty_cells))
+
+
+# Асинхронные версии функций для вызова из обработчиков Telegram
+
+async def add_user_async(telegram_id: int, user_name: str, first_name: str, last_name: str, user_type: str = "guest"):
+    return await run_in_db_executor(add_user, telegram_id, user_name, first_name, last_name, user_type)
+
+
+async def is_admin_async(user_id: int) -> tuple:
+    # попадание в кэш ролей не требует перехода в пул потоков
+    cached = role_cache.get(user_id)
+    if cached is not None:
+        return cached
+    return await run_in_db_executor(fetch_admin_role, user_id)
+
+
+async def save_to_database_async(user_id, usage_data, dirty_cells=None):
+    return await asyncio.wrap_future(save_to_database_in_background(user_id, usage_data, dirty_cells))
+
+
+async def save_usage_batch_async(cost_rows, history_rows) -> bool:
+    return await asyncio.wrap_future(_db_write_executor.submit(save_usage_batch, cost_rows, history_rows))
+
+
+async def get_user_usage_async(user_id):
+    return await run_in_db_executor(get_user_usage, user_id)
@@ -0,0 +1,243 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+def cache_key(*parts) -> str:
+    """
+    Builds a cache key from the given JSON-serializable parts.
+    """
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def _logged(func, *args):
+    try:
+        return func(*args)
+    except Exception as e:
+        logging.warning(f'Cache error in {func.__name__}: {str(e)}')
+        return None
+
+
+class PersistentLRUCache:
+    """
+    Least recently used cache of JSON-serializable values with a time to live.
+    The most recently used entries are kept in memory, all entries are kept in an SQLite file,
+    if a path is given, so that they survive restarts. The file is read and written on a
+    background thread, writes don't wait for it.
+    """
+
+    def __init__(self, path: str | None, max_entries: int = 1000, ttl: float = 7 * 24 * 3600,
+                 max_memory_entries: int = 200):
+        """
+        :param path: Path of the SQLite file, or None to keep the cache in memory only
+        :param max_entries: Maximum number of entries kept in the file
+        :param ttl: Time in seconds after which an entry expires
+        :param max_memory_entries: Maximum number of entries kept in memory
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_memory_entries = max_memory_entries
+        self._memory = OrderedDict()  # {key: (expires_at, value)}, most recently used last
+        self._connection = None
+        self._executor = None
+        if path is not None:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cache')
+            self._executor.submit(_logged, self._setup)
+
+    def _setup(self):
+        # the connection is only used from the cache thread
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        with self._connection:
+            self._connection.execute('''
+                CREATE TABLE IF NOT EXISTS cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )''')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS cache_last_used ON cache (last_used)')
+            self._connection.execute('DELETE FROM cache WHERE expires_at <= ?', (time.time(),))
+
+    def _remember(self, key, expires_at, value):
+        self._memory[key] = (expires_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    async def get(self, key: str):
+        """
+        Gets a cached value.
+        :param key: The key, see cache_key
+        :return: The value, or None if it is not cached or expired
+        """
+        entry = self._memory.get(key)
+        if entry is not None:
+            if entry[0] > time.time():
+                self._memory.move_to_end(key)
+                return entry[1]
+            del self._memory[key]
+        if self._executor is None:
+            return None
+        row = await asyncio.get_running_loop().run_in_executor(self._executor, _logged, self._load, key)
+        if row is None:
+            return None
+        expires_at, value = row
+        self._remember(key, expires_at, value)
+        return value
+
+    def put(self, key: str, value, ttl: float | None = None):
+        """
+        Caches a value.
+        :param key: The key, see cache_key
+        :param value: The value, must be JSON-serializable
+        :param ttl: Time in seconds after which the value expires, the cache's time to live if not given
+        """
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        self._remember(key, expires_at, value)
+        if self._executor is not None:
+            self._executor.submit(_logged, self._store, key, json.dumps(value), expires_at)
+
+    def delete(self, key: str):
+        """
+        Removes a value from the cache.
+        """
+        self._memory.pop(key, None)
+        if self._executor is not None:
+            self._executor.submit(_logged, self._delete, key)
+
+    def close(self):
+        """
+        Waits for pending writes and closes the file.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            if self._connection is not None:
+                self._connection.close()
+
+    def _load(self, key):
+        now = time.time()
+        row = self._connection.execute('SELECT value, expires_at FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        with self._connection:
+            if expires_at <= now:
+                self._connection.execute('DELETE FROM cache WHERE key = ?', (key,))
+                return None
+            self._connection.execute('UPDATE cache SET last_used = ? WHERE key = ?', (now, key))
+        return expires_at, json.loads(value)
+
+    def _store(self, key, value, expires_at):
+        with self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO cache (key, value, expires_at, last_used) VALUES (?, ?, ?, ?)',
+                (key, value, expires_at, time.time()))
+            # evict the least recently used entries above the limit
+            self._connection.execute(
+                'DELETE FROM cache WHERE key IN ('
+                'SELECT key FROM cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+    def _delete(self, key):
+        with self._connection:
+            self._connection.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+
+class FileLRUCache:
+    """
+    Least recently used cache of binary data, kept as one file per entry in a directory
+    and bounded by the total size of the files. The files are read and written on a
+    background thread, writes don't wait for it. Entries found in the directory at startup
+    are reused, ordered by their modification time, which is updated whenever they are read.
+    """
+
+    def __init__(self, directory: str, max_size: int):
+        """
+        :param directory: The directory of the files
+        :param max_size: Maximum total size of the files in bytes
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self._files = OrderedDict()  # {key: size}, most recently used last, only used on the cache thread
+        self._size = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='file-cache')
+        self._executor.submit(_logged, self._setup)
+
+    async def get(self, key: str) -> bytes | None:
+        """
+        Gets cached data.
+        :param key: The key, see cache_key
+        :return: The data, or None if it is not cached
+        """
+        return await asyncio.get_running_loop().run_in_executor(self._executor, _logged, self._load, key)
+
+    def put(self, key: str, data: bytes):
+        """
+        Caches data, evicting the least recently used entries above the maximum size.
+        :param key: The key, see cache_key
+        :param data: The data
+        """
+        if len(data) <= self.max_size:
+            self._executor.submit(_logged, self._store, key, bytes(data))
+
+    def close(self):
+        """
+        Waits for pending writes.
+        """
+        self._executor.shutdown(wait=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _setup(self):
+        os.makedirs(self.directory, exist_ok=True)
+        entries = [entry for entry in os.scandir(self.directory) if entry.is_file() and not entry.name.endswith('.tmp')]
+        for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+            self._files[entry.name] = entry.stat().st_size
+            self._size += entry.stat().st_size
+        self._evict()
+
+    def _load(self, key):
+        if key not in self._files:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            self._size -= self._files.pop(key)
+            return None
+        os.utime(path)
+        self._files.move_to_end(key)
+        return data
+
+    def _store(self, key, data):
+        path = self._path(key)
+        # written to a temporary file first, so that a crash never leaves a partial entry
+        with open(f'{path}.tmp', 'wb') as file:
+            file.write(data)
+        os.replace(f'{path}.tmp', path)
+        self._size += len(data) - self._files.pop(key, 0)
+        self._files[key] = len(data)
+        self._evict()
+
+    def _evict(self):
+        while self._size > self.max_size and self._files:
+            key, size = self._files.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,329 @@
+from __future__ import annotations
+
+import abc
+import asyncio
+import datetime
+import json
+import logging
+import os
+import sqlite3
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+
+from psycopg2.extras import execute_values
+
+from bd import DatabaseConnection
+
+
+def _completed(result=None) -> Future:
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+@contextmanager
+def _database_connection():
+    with DatabaseConnection() as connection:
+        if connection is None:
+            raise ConnectionError('No connection to the database')
+        yield connection
+
+
+class ConversationStore:
+    """
+    Keeps conversations in memory only. Base class of the persistent conversation stores.
+    A conversation is saved as its messages, the token count of each message,
+    the vision flag and the time of the last update.
+    """
+
+    def load(self, chat_id: int) -> Future:
+        """
+        Loads a conversation.
+        :param chat_id: The chat ID
+        :return: A future with a tuple (messages, message_tokens, is_vision, last_updated),
+                 or None if the conversation is not stored
+        """
+        return _completed()
+
+    async def load_async(self, chat_id: int):
+        """
+        Loads a conversation without blocking the event loop.
+        """
+        return await asyncio.wrap_future(self.load(chat_id))
+
+    def append(self, chat_id: int, position: int, message: dict, tokens: int):
+        """
+        Saves a message appended to a conversation, or replacing the message at the given position.
+        :param chat_id: The chat ID
+        :param position: The index of the message in the conversation history
+        :param message: The message
+        :param tokens: The token count of the message
+        """
+
+    def replace(self, chat_id: int, messages: list, message_tokens: list):
+        """
+        Saves a conversation history that replaced the previous one.
+        """
+
+    def update_state(self, chat_id: int, is_vision: bool, last_updated: datetime.datetime | None):
+        """
+        Saves the vision flag and the time of the last update of a conversation.
+        """
+
+    def delete(self, chat_id: int):
+        """
+        Deletes a conversation.
+        """
+
+    def close(self):
+        """
+        Waits for pending writes and releases the store.
+        """
+
+
+class BackgroundConversationStore(ConversationStore, abc.ABC):
+    """
+    Base class of stores backed by a database. All operations run one after another
+    on a single background thread, so writes never block the event loop, are applied
+    in order and a load always sees the writes queued before it.
+    Subclasses implement the _load, _append, _replace, _update_state and _delete methods.
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='conversation-store')
+        self._executor.submit(self._run_logged, self._setup)
+
+    @staticmethod
+    def _run_logged(func, *args):
+        try:
+            return func(*args)
+        except Exception as e:
+            logging.error(f'Conversation store error in {func.__name__}: {str(e)}')
+            return None
+
+    def _submit(self, func, *args):
+        try:
+            return self._executor.submit(self._run_logged, func, *args)
+        except RuntimeError:
+            # the store is already closed
+            logging.warning(f'Conversation store is closed, {func.__name__} was skipped')
+            return _completed()
+
+    def load(self, chat_id: int) -> Future:
+        return self._submit(self._load, chat_id)
+
+    def append(self, chat_id: int, position: int, message: dict, tokens: int):
+        self._submit(self._append, chat_id, position, json.dumps(message), tokens)
+
+    def replace(self, chat_id: int, messages: list, message_tokens: list):
+        rows = [(position, json.dumps(message), tokens)
+                for position, (message, tokens) in enumerate(zip(messages, message_tokens))]
+        self._submit(self._replace, chat_id, rows)
+
+    def update_state(self, chat_id: int, is_vision: bool, last_updated: datetime.datetime | None):
+        self._submit(self._update_state, chat_id, is_vision, last_updated)
+
+    def delete(self, chat_id: int):
+        self._submit(self._delete, chat_id)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._close()
+
+    def _setup(self):
+        pass
+
+    def _close(self):
+        pass
+
+    @abc.abstractmethod
+    def _load(self, chat_id):
+        pass
+
+    @abc.abstractmethod
+    def _append(self, chat_id, position, message, tokens):
+        pass
+
+    @abc.abstractmethod
+    def _replace(self, chat_id, rows):
+        pass
+
+    @abc.abstractmethod
+    def _update_state(self, chat_id, is_vision, last_updated):
+        pass
+
+    @abc.abstractmethod
+    def _delete(self, chat_id):
+        pass
+
+
+class SQLiteConversationStore(BackgroundConversationStore):
+    """
+    Stores conversations in a local SQLite database file.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: Path of the database file
+        """
+        self.path = path
+        self.connection = None
+        super().__init__()
+
+    def _setup(self):
+        # the connection is only used from the store thread, and closed once it has stopped
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS conversations (
+                    chat_id INTEGER PRIMARY KEY,
+                    is_vision INTEGER NOT NULL DEFAULT 0,
+                    last_updated TEXT
+                )''')
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS conversation_messages (
+                    chat_id INTEGER NOT NULL,
+                    position INTEGER NOT NULL,
+                    message TEXT NOT NULL,
+                    tokens INTEGER NOT NULL,
+                    PRIMARY KEY (chat_id, position)
+                )''')
+
+    def _close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+    def _load(self, chat_id):
+        state = self.connection.execute(
+            'SELECT is_vision, last_updated FROM conversations WHERE chat_id = ?', (chat_id,)).fetchone()
+        rows = self.connection.execute(
+            'SELECT message, tokens FROM conversation_messages WHERE chat_id = ? ORDER BY position',
+            (chat_id,)).fetchall()
+        if not rows:
+            return None
+        is_vision, last_updated = state if state is not None else (False, None)
+        last_updated = datetime.datetime.fromisoformat(last_updated) if last_updated else None
+        return [json.loads(message) for message, _ in rows], [tokens for _, tokens in rows], \
+            bool(is_vision), last_updated
+
+    def _append(self, chat_id, position, message, tokens):
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO conversation_messages (chat_id, position, message, tokens) '
+                'VALUES (?, ?, ?, ?)', (chat_id, position, message, tokens))
+
+    def _replace(self, chat_id, rows):
+        with self.connection:
+            self.connection.execute('DELETE FROM conversation_messages WHERE chat_id = ?', (chat_id,))
+            self.connection.executemany(
+                'INSERT INTO conversation_messages (chat_id, position, message, tokens) VALUES (?, ?, ?, ?)',
+                [(chat_id,) + row for row in rows])
+
+    def _update_state(self, chat_id, is_vision, last_updated):
+        with self.connection:
+            self.connection.execute(
+                'INSERT INTO conversations (chat_id, is_vision, last_updated) VALUES (?, ?, ?) '
+                'ON CONFLICT (chat_id) DO UPDATE SET is_vision = excluded.is_vision, '
+                'last_updated = excluded.last_updated',
+                (chat_id, int(is_vision), last_updated.isoformat() if last_updated else None))
+
+    def _delete(self, chat_id):
+        with self.connection:
+            self.connection.execute('DELETE FROM conversation_messages WHERE chat_id = ?', (chat_id,))
+            self.connection.execute('DELETE FROM conversations WHERE chat_id = ?', (chat_id,))
+
+
+class PostgresConversationStore(BackgroundConversationStore):
+    """
+    Stores conversations in the bot's PostgreSQL database, using the shared connection pool.
+    """
+
+    def _setup(self):
+        with _database_connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS conversations (
+                        chat_id BIGINT PRIMARY KEY,
+                        is_vision BOOLEAN NOT NULL DEFAULT FALSE,
+                        last_updated TIMESTAMP
+                    )''')
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS conversation_messages (
+                        chat_id BIGINT NOT NULL,
+                        position INTEGER NOT NULL,
+                        message JSONB NOT NULL,
+                        tokens INTEGER NOT NULL,
+                        PRIMARY KEY (chat_id, position)
+                    )''')
+            connection.commit()
+
+    def _load(self, chat_id):
+        with _database_connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT is_vision, last_updated FROM conversations WHERE chat_id = %s', (chat_id,))
+                state = cursor.fetchone()
+                cursor.execute('SELECT message, tokens FROM conversation_messages '
+                               'WHERE chat_id = %s ORDER BY position', (chat_id,))
+                rows = cursor.fetchall()
+        if not rows:
+            return None
+        is_vision, last_updated = state if state is not None else (False, None)
+        return [message for message, _ in rows], [tokens for _, tokens in rows], is_vision, last_updated
+
+    def _append(self, chat_id, position, message, tokens):
+        with _database_connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'INSERT INTO conversation_messages (chat_id, position, message, tokens) '
+                    'VALUES (%s, %s, %s, %s) ON CONFLICT (chat_id, position) '
+                    'DO UPDATE SET message = EXCLUDED.message, tokens = EXCLUDED.tokens',
+                    (chat_id, position, message, tokens))
+            connection.commit()
+
+    def _replace(self, chat_id, rows):
+        with _database_connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute('DELETE FROM conversation_messages WHERE chat_id = %s', (chat_id,))
+                if rows:
+                    execute_values(cursor,
+                                   'INSERT INTO conversation_messages (chat_id, position, message, tokens) '
+                                   'VALUES %s', [(chat_id,) + row for row in rows])
+            connection.commit()
+
+    def _update_state(self, chat_id, is_vision, last_updated):
+        with _database_connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'INSERT INTO conversations (chat_id, is_vision, last_updated) VALUES (%s, %s, %s) '
+                    'ON CONFLICT (chat_id) DO UPDATE SET is_vision = EXCLUDED.is_vision, '
+                    'last_updated = EXCLUDED.last_updated',
+                    (chat_id, is_vision, last_updated))
+            connection.commit()
+
+    def _delete(self, chat_id):
+        with _database_connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute('DELETE FROM conversation_messages WHERE chat_id = %s', (chat_id,))
+                cursor.execute('DELETE FROM conversations WHERE chat_id = %s', (chat_id,))
+            connection.commit()
+
+
+def create_conversation_store(backend: str, path: str = 'conversations.db') -> ConversationStore:
+    """
+    Creates the conversation store for the configured backend.
+    :param backend: 'memory', 'sqlite' or 'postgres'
+    :param path: Path of the database file for the SQLite backend
+    :return: The conversation store
+    """
+    if backend == 'memory':
+        return ConversationStore()
+    if backend == 'sqlite':
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        return SQLiteConversationStore(path)
+    if backend == 'postgres':
+        return PostgresConversationStore()
+    raise ValueError(f'Unknown conversation store {backend}, expected memory, sqlite or postgres')
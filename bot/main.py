@@ -3,6 +3,8 @@ import os
 
 from dotenv import load_dotenv
 
+from access_policy import AccessPolicy
+from conversation_store import create_conversation_store
 from plugin_manager import PluginManager
 from openai_helper import OpenAIHelper, default_max_tokens, are_functions_available
 from telegram_bot import ChatGPTTelegramBot
@@ -40,6 +42,9 @@ def main():
         'proxy': os.environ.get('PROXY', None) or os.environ.get('OPENAI_PROXY', None),
         'max_history_size': int(os.environ.get('MAX_HISTORY_SIZE', 15)),
         'max_conversation_age_minutes': int(os.environ.get('MAX_CONVERSATION_AGE_MINUTES', 180)),
+        'summary_soft_threshold': float(os.environ.get('SUMMARY_SOFT_THRESHOLD', 0.8)),
+        'summary_model': os.environ.get('SUMMARY_MODEL', model),
+        'summary_max_tokens': int(os.environ.get('SUMMARY_MAX_TOKENS', 400)),
         'assistant_prompt': os.environ.get('ASSISTANT_PROMPT', 'You are a helpful assistant.'),
         'max_tokens': int(os.environ.get('MAX_TOKENS', max_tokens_default)),
         'n_choices': int(os.environ.get('N_CHOICES', 1)),
@@ -56,13 +61,23 @@ def main():
         'bot_language': os.environ.get('BOT_LANGUAGE', 'en'),
         'show_plugins_used': os.environ.get('SHOW_PLUGINS_USED', 'false').lower() == 'true',
         'whisper_prompt': os.environ.get('WHISPER_PROMPT', ''),
+        'transcription_max_parallel': int(os.environ.get('TRANSCRIPTION_MAX_PARALLEL', 4)),
         'vision_model': os.environ.get('VISION_MODEL', 'gpt-4-vision-preview'),
         'enable_vision_follow_up_questions': os.environ.get('ENABLE_VISION_FOLLOW_UP_QUESTIONS', 'true').lower() == 'true',
         'vision_prompt': os.environ.get('VISION_PROMPT', 'What is in this image'),
         'vision_detail': os.environ.get('VISION_DETAIL', 'auto'),
         'vision_max_tokens': int(os.environ.get('VISION_MAX_TOKENS', '300')),
+        'vision_image_format': os.environ.get('VISION_IMAGE_FORMAT', 'jpeg').lower(),
+        'vision_image_quality': int(os.environ.get('VISION_IMAGE_QUALITY', 85)),
+        'vision_demote_images': os.environ.get('VISION_DEMOTE_IMAGES', 'false').lower() == 'true',
         'tts_model': os.environ.get('TTS_MODEL', 'tts-1'),
         'tts_voice': os.environ.get('TTS_VOICE', 'alloy'),
+        'tts_segment_chars': int(os.environ.get('TTS_SEGMENT_CHARS', 0)),
+        'tts_max_parallel': int(os.environ.get('TTS_MAX_PARALLEL', 4)),
+        'tts_cache_size_mb': float(os.environ.get('TTS_CACHE_SIZE_MB', 100)),
+        'cache_dir': os.environ.get('CACHE_DIR', 'cache'),
+        'conversation_store': os.environ.get('CONVERSATION_STORE', 'memory').lower(),
+        'conversation_store_path': os.environ.get('CONVERSATION_STORE_PATH', 'conversations.db'),
     }
 
     if openai_config['enable_functions'] and not functions_available:
@@ -105,7 +120,19 @@ def main():
         'tts_prices': [float(i) for i in os.environ.get('TTS_PRICES', "0.015,0.030").split(",")],
         'transcription_price': float(os.environ.get('TRANSCRIPTION_PRICE', 0.006)),
         'bot_language': os.environ.get('BOT_LANGUAGE', 'en'),
+        'usage_flush_interval': float(os.environ.get('USAGE_FLUSH_INTERVAL_SECONDS', 5.0)),
+        'usage_flush_max_pending': int(os.environ.get('USAGE_FLUSH_MAX_PENDING', 100)),
+        'usage_prewarm_days': int(os.environ.get('USAGE_PREWARM_DAYS', 0)),
+        'new_users_flush_interval': float(os.environ.get('NEW_USERS_FLUSH_INTERVAL_SECONDS', 2.0)),
+        'group_membership_cache_ttl': float(os.environ.get('GROUP_MEMBERSHIP_CACHE_TTL_SECONDS', 300.0)),
+        'conversation_sweep_interval': float(os.environ.get('CONVERSATION_SWEEP_INTERVAL_SECONDS', 60.0)),
+        'ffmpeg_max_processes': int(os.environ.get('FFMPEG_MAX_PROCESSES', os.cpu_count() or 1)),
+        'transcription_chunk_seconds': int(os.environ.get('TRANSCRIPTION_CHUNK_SECONDS', 0)),
+        'cache_dir': os.environ.get('CACHE_DIR', 'cache'),
+        'transcript_cache_size': int(os.environ.get('TRANSCRIPT_CACHE_SIZE', 1000)),
+        'transcript_cache_ttl': float(os.environ.get('TRANSCRIPT_CACHE_TTL_SECONDS', 7 * 24 * 3600)),
     }
+    telegram_config['access_policy'] = AccessPolicy.from_config(telegram_config)
 
     plugin_config = {
         'plugins': os.environ.get('PLUGINS', '').split(',')
@@ -113,8 +140,13 @@ def main():
 
     # Настройка и запуск ChatGPT и Telegram бота
     plugin_manager = PluginManager(config=plugin_config)
-    openai_helper = OpenAIHelper(config=openai_config, plugin_manager=plugin_manager)
+    conversation_store = create_conversation_store(openai_config['conversation_store'],
+                                                   openai_config['conversation_store_path'])
+    openai_helper = OpenAIHelper(config=openai_config, plugin_manager=plugin_manager,
+                                 conversation_store=conversation_store)
     telegram_bot = ChatGPTTelegramBot(config=telegram_config, openai=openai_helper)
+    if telegram_config['usage_prewarm_days'] > 0:
+        telegram_bot.prewarm_usage(telegram_config['usage_prewarm_days'])
     telegram_bot.run()
 
 
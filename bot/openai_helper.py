@@ -1,5 +1,8 @@
 from __future__ import annotations
+import asyncio
+import bisect
 import datetime
+import itertools
 import logging
 import os
 
@@ -17,8 +20,11 @@ from PIL import Image
 
 from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
 
-from utils import is_direct_result, encode_image, decode_image
+from utils import is_direct_result, encode_image, decode_image, IdleSweeper, prepare_vision_image, \
+    run_in_image_executor, split_into_sentence_chunks
 from plugin_manager import PluginManager
+from conversation_store import ConversationStore
+from cache import FileLRUCache, PersistentLRUCache, cache_key
 
 # Models can be found here: https://platform.openai.com/docs/models/overview
 # Models gpt-3.5-turbo-0613 and  gpt-3.5-turbo-16k-0613 will be deprecated on June 13, 2024
@@ -30,6 +36,14 @@ GPT_4_VISION_MODELS = ("gpt-4-vision-preview",)
 GPT_4_128K_MODELS = ("gpt-4-1106-preview","gpt-4-0125-preview","gpt-4-turbo-preview", "gpt-4-turbo", "gpt-4-turbo-2024-04-09")
 GPT_4O_MODELS = ("gpt-4o",)
 GPT_ALL_MODELS = GPT_3_MODELS + GPT_3_16K_MODELS + GPT_4_MODELS + GPT_4_32K_MODELS + GPT_4_VISION_MODELS + GPT_4_128K_MODELS + GPT_4O_MODELS
+# Models that accept images, all billed per 512px tile: https://platform.openai.com/docs/guides/vision
+GPT_VISION_TILE_MODELS = GPT_4_VISION_MODELS + ("gpt-4-turbo", "gpt-4-turbo-2024-04-09") + GPT_4O_MODELS
+
+# Name of the assistant message holding the summary of the earlier conversation, which marks it as pinned
+SUMMARY_MESSAGE_NAME = 'conversation_summary'
+
+# Text an image is replaced with when it is demoted, the answer to it follows in the history
+DEMOTED_IMAGE_PLACEHOLDER = '[image, described in the next message]'
 
 def default_max_tokens(model: str) -> int:
     """
@@ -104,11 +118,12 @@ class OpenAIHelper:
     ChatGPT helper class.
     """
 
-    def __init__(self, config: dict, plugin_manager: PluginManager):
+    def __init__(self, config: dict, plugin_manager: PluginManager, conversation_store: ConversationStore = None):
         """
         Initializes the OpenAI helper class with the given configuration.
         :param config: A dictionary containing the GPT configuration
         :param plugin_manager: The plugin manager
+        :param conversation_store: The store conversations are persisted to, in memory only if not given
         """
         http_client = httpx.AsyncClient(proxies=config['proxy']) if 'proxy' in config else None
         self.client = openai.AsyncOpenAI(api_key=config['api_key'], http_client=http_client)
@@ -117,6 +132,64 @@ class OpenAIHelper:
         self.conversations: dict[int: list] = {}  # {chat_id: history}
         self.conversations_vision: dict[int: bool] = {}  # {chat_id: is_vision}
         self.last_updated: dict[int: datetime] = {}  # {chat_id: last_update_timestamp}
+        self.message_tokens: dict[int: list] = {}  # {chat_id: [token count of each message in history]}
+        self.conversation_tokens: dict[int: int] = {}  # {chat_id: sum of message_tokens}
+        self.history_generation: dict[int: int] = {}  # {chat_id: changes whenever the history is replaced}
+        self.summary_tasks: dict[int: asyncio.Task] = {}  # {chat_id: running background summary}
+        self.summary_floor: dict[int: tuple] = {}  # {chat_id: (history size, tokens) left by the last summary}
+        self.__generations = itertools.count()
+        self.conversation_store = conversation_store or ConversationStore()
+        # conversations past their max age are dropped from memory, they stay in the conversation store
+        self.conversation_sweeper = IdleSweeper(config['max_conversation_age_minutes'] * 60,
+                                                self.evict_conversation)
+        # synthesized speech is cached by its text and voice, and after its first upload by its Telegram file_id
+        cache_dir = config['cache_dir']
+        self.speech_cache = FileLRUCache(os.path.join(cache_dir, 'speech'),
+                                         int(config['tts_cache_size_mb'] * 1024 * 1024)) \
+            if cache_dir and config['tts_cache_size_mb'] > 0 else None
+        self.speech_file_ids = PersistentLRUCache(
+            os.path.join(cache_dir, 'speech_file_ids.db') if cache_dir else None, ttl=30 * 24 * 3600)
+        # Telegram file_ids of plugin results by content, see Plugin.get_cached_direct_result
+        self.direct_result_cache = PersistentLRUCache(
+            os.path.join(cache_dir, 'direct_results.db') if cache_dir else None, ttl=30 * 24 * 3600)
+        try:
+            self.encoding = tiktoken.encoding_for_model(config['model'])
+        except KeyError:
+            self.encoding = tiktoken.get_encoding("cl100k_base")
+
+    async def ensure_conversation_loaded(self, chat_id: int):
+        """
+        Loads the conversation of a chat from the conversation store, unless it is already in memory.
+        :param chat_id: The chat ID
+        """
+        if chat_id in self.conversations:
+            return
+        stored = await self.conversation_store.load_async(chat_id)
+        # another request of the same chat may have started the conversation in the meantime
+        if stored is None or chat_id in self.conversations:
+            return
+        messages, message_tokens, is_vision, last_updated = stored
+        self.conversations[chat_id] = messages
+        self.message_tokens[chat_id] = message_tokens
+        self.conversation_tokens[chat_id] = sum(message_tokens)
+        self.history_generation[chat_id] = next(self.__generations)
+        self.conversations_vision[chat_id] = is_vision
+        if last_updated is not None:
+            self.last_updated[chat_id] = last_updated
+        self.conversation_sweeper.touch(chat_id)
+
+    def evict_conversation(self, chat_id: int):
+        """
+        Drops the conversation of a chat from memory.
+        :param chat_id: The chat ID
+        """
+        self.conversations.pop(chat_id, None)
+        self.conversations_vision.pop(chat_id, None)
+        self.last_updated.pop(chat_id, None)
+        self.message_tokens.pop(chat_id, None)
+        self.conversation_tokens.pop(chat_id, None)
+        self.history_generation.pop(chat_id, None)
+        self.summary_floor.pop(chat_id, None)
 
     def get_conversation_stats(self, chat_id: int) -> tuple[int, int]:
         """
@@ -126,7 +199,7 @@ class OpenAIHelper:
         """
         if chat_id not in self.conversations:
             self.reset_chat_history(chat_id)
-        return len(self.conversations[chat_id]), self.__count_tokens(self.conversations[chat_id])
+        return len(self.conversations[chat_id]), self.__count_conversation_tokens(chat_id)
 
     async def get_chat_response(self, chat_id: int, query: str) -> tuple[str, str]:
         """
@@ -136,6 +209,7 @@ class OpenAIHelper:
         :return: The answer from the model and the number of tokens used
         """
         plugins_used = ()
+        await self.ensure_conversation_loaded(chat_id)
         response = await self.__common_get_chat_response(chat_id, query)
         if self.config['enable_functions'] and not self.conversations_vision[chat_id]:
             response, plugins_used = await self.__handle_function_call(chat_id, response)
@@ -179,6 +253,7 @@ class OpenAIHelper:
         :return: The answer from the model and the number of tokens used, or 'not_finished'
         """
         plugins_used = ()
+        await self.ensure_conversation_loaded(chat_id)
         response = await self.__common_get_chat_response(chat_id, query, stream=True)
         if self.config['enable_functions'] and not self.conversations_vision[chat_id]:
             response, plugins_used = await self.__handle_function_call(chat_id, response, stream=True)
@@ -196,7 +271,7 @@ class OpenAIHelper:
                 yield answer, 'not_finished'
         answer = answer.strip()
         self.__add_to_history(chat_id, role="assistant", content=answer)
-        tokens_used = str(self.__count_tokens(self.conversations[chat_id]))
+        tokens_used = str(self.__count_conversation_tokens(chat_id))
 
         show_plugins_used = len(plugins_used) > 0 and self.config['show_plugins_used']
         plugin_names = tuple(self.plugin_manager.get_plugin_source_name(plugin) for plugin in plugins_used)
@@ -228,29 +303,16 @@ class OpenAIHelper:
                 self.reset_chat_history(chat_id)
 
             self.last_updated[chat_id] = datetime.datetime.now()
+            self.__save_state(chat_id)
 
             self.__add_to_history(chat_id, role="user", content=query)
 
-            # Summarize the chat history if it's too long to avoid excessive token usage
-            token_count = self.__count_tokens(self.conversations[chat_id])
-            exceeded_max_tokens = token_count + self.config['max_tokens'] > self.__max_model_tokens()
-            exceeded_max_history_size = len(self.conversations[chat_id]) > self.config['max_history_size']
-
-            if exceeded_max_tokens or exceeded_max_history_size:
-                logging.info(f'Chat history for chat ID {chat_id} is too long. Summarising...')
-                try:
-                    summary = await self.__summarise(self.conversations[chat_id][:-1])
-                    logging.debug(f'Summary: {summary}')
-                    self.reset_chat_history(chat_id, self.conversations[chat_id][0]['content'])
-                    self.__add_to_history(chat_id, role="assistant", content=summary)
-                    self.__add_to_history(chat_id, role="user", content=query)
-                except Exception as e:
-                    logging.warning(f'Error while summarising chat history: {str(e)}. Popping elements instead...')
-                    self.conversations[chat_id] = self.conversations[chat_id][-self.config['max_history_size']:]
+            # Summarize the chat history in the background if it's getting long to avoid excessive token usage
+            self.__summarise_if_needed(chat_id)
 
             common_args = {
                 'model': self.config['model'] if not self.conversations_vision[chat_id] else self.config['vision_model'],
-                'messages': self.conversations[chat_id],
+                'messages': self.__request_messages(chat_id),
                 'temperature': self.config['temperature'],
                 'n': self.config['n_choices'],
                 'max_tokens': self.config['max_tokens'],
@@ -321,7 +383,7 @@ class OpenAIHelper:
         self.__add_function_call_to_history(chat_id=chat_id, function_name=function_name, content=function_response)
         response = await self.client.chat.completions.create(
             model=self.config['model'],
-            messages=self.conversations[chat_id],
+            messages=self.__request_messages(chat_id),
             functions=self.plugin_manager.get_functions_specs(),
             function_call='auto' if times < self.config['functions_max_consecutive_calls'] else 'none',
             stream=stream
@@ -356,13 +418,37 @@ class OpenAIHelper:
         except Exception as e:
             raise Exception(f"⚠️ _{localized_text('error', bot_language)}._ ⚠️\n{str(e)}") from e
 
+    def speech_cache_key(self, text: str) -> str:
+        """
+        Gets the cache key of the speech generated from the given text with the configured model and voice.
+        """
+        return cache_key(text, self.config['tts_model'], self.config['tts_voice'])
+
+    async def get_speech_file_id(self, text: str) -> str | None:
+        """
+        Gets the Telegram file_id of the voice message uploaded for the given text, if any.
+        """
+        return await self.speech_file_ids.get(self.speech_cache_key(text))
+
+    def set_speech_file_id(self, text: str, file_id: str):
+        """
+        Remembers the Telegram file_id of the voice message uploaded for the given text,
+        so that it is sent again by reference instead of being generated and uploaded again.
+        """
+        self.speech_file_ids.put(self.speech_cache_key(text), file_id)
+
     async def generate_speech(self, text: str) -> tuple[any, int]:
         """
         Generates an audio from the given text using TTS model.
         :param prompt: The text to send to the model
-        :return: The audio in bytes and the text size
+        :return: The audio in bytes and the number of characters synthesized, 0 if the audio was cached
         """
         bot_language = self.config['bot_language']
+        key = self.speech_cache_key(text)
+        if self.speech_cache is not None:
+            cached = await self.speech_cache.get(key)
+            if cached is not None:
+                return io.BytesIO(cached), 0
         try:
             response = await self.client.audio.speech.create(
                 model=self.config['tts_model'],
@@ -371,13 +457,45 @@ class OpenAIHelper:
                 response_format='opus'
             )
 
-            temp_file = io.BytesIO()
-            temp_file.write(response.read())
-            temp_file.seek(0)
-            return temp_file, len(text)
+            data = response.read()
+            if self.speech_cache is not None:
+                self.speech_cache.put(key, data)
+            return io.BytesIO(data), len(text)
         except Exception as e:
             raise Exception(f"⚠️ _{localized_text('error', bot_language)}._ ⚠️\n{str(e)}") from e
 
+    async def generate_speech_segments(self, text: str):
+        """
+        Generates audio from the given text in segments of whole sentences, so that the first segment
+        can be sent while the others are still being synthesized. The segments are synthesized
+        concurrently, at most tts_max_parallel at a time, and yielded in order. A text no longer
+        than tts_segment_chars, or any text if that is 0, is a single segment.
+        :param text: The text to send to the model
+        :return: An async generator of (segment text, voice, number of characters synthesized) tuples, where
+                 voice is the Telegram file_id of a segment uploaded before, or else the audio in bytes
+        """
+        segment_chars = self.config['tts_segment_chars']
+        segments = split_into_sentence_chunks(text, segment_chars) \
+            if 0 < segment_chars < len(text) else [text]
+        semaphore = asyncio.Semaphore(self.config['tts_max_parallel'])
+
+        async def generate_segment(segment):
+            file_id = await self.get_speech_file_id(segment)
+            if file_id is not None:
+                return file_id, 0
+            async with semaphore:
+                return await self.generate_speech(segment)
+
+        # tasks are started in order, so the semaphore lets the first segments through first
+        tasks = [asyncio.create_task(generate_segment(segment)) for segment in segments]
+        try:
+            for segment, task in zip(segments, tasks):
+                voice, text_length = await task
+                yield segment, voice, text_length
+        finally:
+            for task in tasks:
+                task.cancel()
+
     async def transcribe(self, filename):
         """
         Transcribes the audio file using the Whisper model.
@@ -391,17 +509,39 @@ class OpenAIHelper:
             logging.exception(e)
             raise Exception(f"⚠️ _{localized_text('error', self.config['bot_language'])}._ ⚠️\n{str(e)}") from e
 
+    async def transcribe_segments(self, filenames) -> str:
+        """
+        Transcribes consecutive segments of a recording concurrently and joins the transcripts in order.
+        :param filenames: The audio files of the segments, in order
+        :return: The transcript of the recording
+        """
+        semaphore = asyncio.Semaphore(self.config['transcription_max_parallel'])
+        transcripts = [None] * len(filenames)
+
+        async def transcribe_segment(index):
+            async with semaphore:
+                transcripts[index] = (await self.transcribe(filenames[index])).strip()
+
+        tasks = [asyncio.create_task(transcribe_segment(index)) for index in range(len(filenames))]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+        return ' '.join(transcript for transcript in transcripts if transcript)
+
     @retry(
         reraise=True,
         retry=retry_if_exception_type(openai.RateLimitError),
         wait=wait_fixed(20),
         stop=stop_after_attempt(3)
     )
-    async def __common_get_chat_response_vision(self, chat_id: int, content: list, stream=False):
+    async def __common_get_chat_response_vision(self, chat_id: int, content: list, fileobj, stream=False):
         """
         Request a response from the GPT model.
         :param chat_id: The chat ID
         :param query: The query to send to the model
+        :param fileobj: The image in the content, its tokens are counted for the history
         :return: The answer from the model and the number of tokens used
         """
         bot_language = self.config['bot_language']
@@ -413,38 +553,25 @@ class OpenAIHelper:
 
             if self.config['enable_vision_follow_up_questions']:
                 self.conversations_vision[chat_id] = True
-                self.__add_to_history(chat_id, role="user", content=content)
+                message = {"role": "user", "content": content}
+                image_tokens = self.__count_tokens_vision(fileobj)
+                self.__append_to_history(chat_id, message, self.__count_message_tokens(message, image_tokens))
             else:
                 for message in content:
                     if message['type'] == 'text':
                         query = message['text']
                         break
                 self.__add_to_history(chat_id, role="user", content=query)
+            self.__save_state(chat_id)
 
-            # Summarize the chat history if it's too long to avoid excessive token usage
-            token_count = self.__count_tokens(self.conversations[chat_id])
-            exceeded_max_tokens = token_count + self.config['max_tokens'] > self.__max_model_tokens()
-            exceeded_max_history_size = len(self.conversations[chat_id]) > self.config['max_history_size']
-
-            if exceeded_max_tokens or exceeded_max_history_size:
-                logging.info(f'Chat history for chat ID {chat_id} is too long. Summarising...')
-                try:
-                    
-                    last = self.conversations[chat_id][-1]
-                    summary = await self.__summarise(self.conversations[chat_id][:-1])
-                    logging.debug(f'Summary: {summary}')
-                    self.reset_chat_history(chat_id, self.conversations[chat_id][0]['content'])
-                    self.__add_to_history(chat_id, role="assistant", content=summary)
-                    self.conversations[chat_id] += [last]
-                except Exception as e:
-                    logging.warning(f'Error while summarising chat history: {str(e)}. Popping elements instead...')
-                    self.conversations[chat_id] = self.conversations[chat_id][-self.config['max_history_size']:]
+            # Summarize the chat history in the background if it's getting long to avoid excessive token usage
+            self.__summarise_if_needed(chat_id)
 
             message = {'role':'user', 'content':content}
 
             common_args = {
                 'model': self.config['vision_model'],
-                'messages': self.conversations[chat_id][:-1] + [message],
+                'messages': self.__request_messages(chat_id, self.config['vision_max_tokens'])[:-1] + [message],
                 'temperature': self.config['temperature'],
                 'n': 1, # several choices is not implemented yet
                 'max_tokens': self.config['vision_max_tokens'],
@@ -474,17 +601,27 @@ class OpenAIHelper:
             raise Exception(f"⚠️ _{localized_text('error', bot_language)}._ ⚠️\n{str(e)}") from e
 
 
+    async def prepare_image(self, fileobj):
+        """
+        Downscales and re-encodes an image for the Vision model, without blocking the event loop.
+        :param fileobj: The image file
+        :return: The image to send
+        """
+        return await run_in_image_executor(prepare_vision_image, fileobj, self.config['vision_detail'],
+                                           self.config['vision_image_format'], self.config['vision_image_quality'])
+
     async def interpret_image(self, chat_id, fileobj, prompt=None):
         """
-        Interprets a given PNG image file using the Vision model.
+        Interprets a given image file, prepared with prepare_image, using the Vision model.
         """
-        image = encode_image(fileobj)
+        await self.ensure_conversation_loaded(chat_id)
+        image = await run_in_image_executor(encode_image, fileobj)
         prompt = self.config['vision_prompt'] if prompt is None else prompt
 
         content = [{'type':'text', 'text':prompt}, {'type':'image_url', \
                     'image_url': {'url':image, 'detail':self.config['vision_detail'] } }]
 
-        response = await self.__common_get_chat_response_vision(chat_id, content)
+        response = await self.__common_get_chat_response_vision(chat_id, content, fileobj)
 
         
 
@@ -508,6 +645,7 @@ class OpenAIHelper:
         else:
             answer = response.choices[0].message.content.strip()
             self.__add_to_history(chat_id, role="assistant", content=answer)
+        self.__demote_images(chat_id)
 
         bot_language = self.config['bot_language']
         # Plugins are not enabled either
@@ -527,15 +665,16 @@ class OpenAIHelper:
 
     async def interpret_image_stream(self, chat_id, fileobj, prompt=None):
         """
-        Interprets a given PNG image file using the Vision model.
+        Interprets a given image file, prepared with prepare_image, using the Vision model.
         """
-        image = encode_image(fileobj)
+        await self.ensure_conversation_loaded(chat_id)
+        image = await run_in_image_executor(encode_image, fileobj)
         prompt = self.config['vision_prompt'] if prompt is None else prompt
 
         content = [{'type':'text', 'text':prompt}, {'type':'image_url', \
                     'image_url': {'url':image, 'detail':self.config['vision_detail'] } }]
 
-        response = await self.__common_get_chat_response_vision(chat_id, content, stream=True)
+        response = await self.__common_get_chat_response_vision(chat_id, content, fileobj, stream=True)
 
         
 
@@ -555,7 +694,8 @@ class OpenAIHelper:
                 yield answer, 'not_finished'
         answer = answer.strip()
         self.__add_to_history(chat_id, role="assistant", content=answer)
-        tokens_used = str(self.__count_tokens(self.conversations[chat_id]))
+        self.__demote_images(chat_id)
+        tokens_used = str(self.__count_conversation_tokens(chat_id))
 
         #show_plugins_used = len(plugins_used) > 0 and self.config['show_plugins_used']
         #plugin_names = tuple(self.plugin_manager.get_plugin_source_name(plugin) for plugin in plugins_used)
@@ -574,8 +714,10 @@ class OpenAIHelper:
         """
         if content == '':
             content = self.config['assistant_prompt']
-        self.conversations[chat_id] = [{"role": "system", "content": content}]
+        self.__set_history(chat_id, [{"role": "system", "content": content}])
+        self.summary_floor.pop(chat_id, None)
         self.conversations_vision[chat_id] = False
+        self.__save_state(chat_id)
 
     def __max_age_reached(self, chat_id) -> bool:
         """
@@ -594,7 +736,7 @@ class OpenAIHelper:
         """
         Adds a function call to the conversation history
         """
-        self.conversations[chat_id].append({"role": "function", "name": function_name, "content": content})
+        self.__append_to_history(chat_id, {"role": "function", "name": function_name, "content": content})
 
     def __add_to_history(self, chat_id, role, content):
         """
@@ -603,7 +745,195 @@ class OpenAIHelper:
         :param role: The role of the message sender
         :param content: The message content
         """
-        self.conversations[chat_id].append({"role": role, "content": content})
+        self.__append_to_history(chat_id, {"role": role, "content": content})
+
+    def __demote_images(self, chat_id):
+        """
+        Replaces the image of the latest vision request in the conversation history with a placeholder,
+        the answer to it stays as its description, so that follow-up questions don't send the image again.
+        Once no image is left, follow-up questions go to the chat model again.
+        Only done if enabled in the configuration.
+        :param chat_id: The chat ID
+        """
+        if not self.config['vision_demote_images']:
+            return
+        history = self.conversations[chat_id]
+        for index in range(len(history) - 2, 0, -1):
+            content = history[index]['content']
+            if isinstance(content, str):
+                continue
+            texts = [part['text'] if part['type'] == 'text' else DEMOTED_IMAGE_PLACEHOLDER for part in content]
+            self.__replace_in_history(chat_id, index, {**history[index], 'content': '\n'.join(texts)})
+            break
+        if not any(isinstance(message['content'], list) for message in history):
+            self.conversations_vision[chat_id] = False
+            self.__save_state(chat_id)
+
+    def __replace_in_history(self, chat_id, index, message):
+        """
+        Replaces a message of the conversation history and its token count.
+        :param chat_id: The chat ID
+        :param index: The index of the message in the conversation history
+        :param message: The new message
+        """
+        tokens = self.__count_message_tokens(message)
+        self.conversation_store.append(chat_id, index, message, tokens)
+        self.conversations[chat_id][index] = message
+        self.conversation_tokens[chat_id] += tokens - self.message_tokens[chat_id][index]
+        self.message_tokens[chat_id][index] = tokens
+
+    def __append_to_history(self, chat_id, message, tokens=None):
+        """
+        Appends a message to the conversation history and keeps its token count,
+        so that only new messages are ever encoded.
+        :param chat_id: The chat ID
+        :param message: The message to append
+        :param tokens: The token count of the message, if already known
+        """
+        if tokens is None:
+            tokens = self.__count_message_tokens(message)
+        self.conversation_store.append(chat_id, len(self.conversations[chat_id]), message, tokens)
+        self.conversations[chat_id].append(message)
+        self.message_tokens[chat_id].append(tokens)
+        self.conversation_tokens[chat_id] += tokens
+
+    def __set_history(self, chat_id, messages, tokens=None):
+        """
+        Replaces the conversation history together with its token counts.
+        :param chat_id: The chat ID
+        :param messages: The new conversation history
+        :param tokens: The token counts of the messages, if already known
+        """
+        if tokens is None:
+            tokens = [self.__count_message_tokens(message) for message in messages]
+        self.conversations[chat_id] = messages
+        self.message_tokens[chat_id] = tokens
+        self.conversation_tokens[chat_id] = sum(tokens)
+        self.history_generation[chat_id] = next(self.__generations)
+        self.conversation_store.replace(chat_id, messages, tokens)
+
+    def __save_state(self, chat_id):
+        """
+        Saves the vision flag and the time of the last update of a conversation to the conversation store
+        and marks the conversation as active.
+        """
+        self.conversation_sweeper.touch(chat_id)
+        self.conversation_store.update_state(chat_id, self.conversations_vision[chat_id],
+                                             self.last_updated.get(chat_id))
+
+    def __truncate_history(self, chat_id, max_history_size):
+        """
+        Keeps only the most recent messages of the conversation history, besides the system prompt
+        and the latest summary.
+        """
+        history = self.conversations[chat_id]
+        tokens = self.message_tokens[chat_id]
+        pinned = self.__pinned_count(history)
+        start = max(pinned, len(history) - max(max_history_size - pinned, 1))
+        # the kept messages begin with a user message, so that no turn is cut in half
+        while start < len(history) - 1 and history[start]['role'] != 'user':
+            start += 1
+        self.__set_history(chat_id, history[:pinned] + history[start:], tokens[:pinned] + tokens[start:])
+
+    def __request_messages(self, chat_id, max_tokens=None) -> list:
+        """
+        Gets the messages of the conversation history to send with a request. The system prompt
+        and the latest summary are always sent, followed by as many of the most recent messages
+        as fit into the model's context window next to the completion.
+        :param chat_id: The chat ID
+        :param max_tokens: The maximum number of tokens of the completion
+        :return: The messages to send
+        """
+        history = self.conversations[chat_id]
+        tokens = self.message_tokens[chat_id]
+        max_tokens = self.config['max_tokens'] if max_tokens is None else max_tokens
+        budget = self.__max_model_tokens() - max_tokens
+        if self.__count_conversation_tokens(chat_id) <= budget:
+            return history
+
+        pinned = self.__pinned_count(history)
+        # every reply is primed with <|start|>assistant<|message|>
+        remaining = budget - 3 - sum(tokens[:pinned])
+        # prefix_sums[i] is the number of tokens of the first i messages after the pinned ones
+        prefix_sums = list(itertools.accumulate(tokens[pinned:], initial=0))
+        start = bisect.bisect_left(prefix_sums, prefix_sums[-1] - remaining)
+        # the current request is sent even if it doesn't fit
+        start = min(start, len(history) - pinned - 1)
+        logging.info(f'Chat history for chat ID {chat_id} is too long. '
+                     f'Sending the {len(history) - pinned - start} most recent messages only...')
+        return history[:pinned] + history[pinned + start:]
+
+    @staticmethod
+    def __pinned_count(history) -> int:
+        """
+        Gets the number of messages at the beginning of the history that are always kept:
+        the system prompt and the summary of the earlier conversation, if any.
+        """
+        if len(history) > 1 and history[1].get('name') == SUMMARY_MESSAGE_NAME:
+            return 2
+        return 1
+
+    def __summarise_if_needed(self, chat_id):
+        """
+        Starts summarising the conversation history in the background once it crosses
+        the soft threshold, a fraction of the token and history size limits.
+        What is left after a summary can already be above the threshold, so the history is
+        summarised again only once it has grown by half the threshold since the last summary.
+        :param chat_id: The chat ID
+        """
+        history_size = len(self.conversations[chat_id])
+        if chat_id in self.summary_tasks or history_size < 3:
+            return
+        soft_threshold = self.config['summary_soft_threshold']
+        token_count = self.__count_conversation_tokens(chat_id)
+        soft_max_tokens = soft_threshold * self.__max_model_tokens() - self.config['max_tokens']
+        soft_max_history_size = soft_threshold * self.config['max_history_size']
+        floor_size, floor_tokens = self.summary_floor.get(chat_id, (0, 0))
+        exceeded_max_tokens = token_count > soft_max_tokens and \
+            token_count >= floor_tokens + soft_max_tokens / 2
+        exceeded_max_history_size = history_size > soft_max_history_size and \
+            history_size >= floor_size + max(soft_max_history_size / 2, 2)
+        if not exceeded_max_tokens and not exceeded_max_history_size:
+            return
+
+        logging.info(f'Chat history for chat ID {chat_id} is getting long. Summarising in the background...')
+        # the last message is the request currently being answered, it is kept as is
+        conversation = self.conversations[chat_id][:-1]
+        task = asyncio.create_task(
+            self.__summarise_in_background(chat_id, conversation, self.history_generation[chat_id]))
+        self.summary_tasks[chat_id] = task
+        task.add_done_callback(lambda _: self.summary_tasks.pop(chat_id, None))
+
+    async def __summarise_in_background(self, chat_id, conversation, generation):
+        """
+        Summarises the beginning of the conversation history and swaps the summary in, keeping
+        the messages added in the meantime. The summary is discarded if the history was replaced
+        meanwhile, e.g. by a reset.
+        :param chat_id: The chat ID
+        :param conversation: The messages to summarise, the beginning of the history
+        :param generation: The history generation the messages were taken from
+        """
+        summarised = len(conversation)
+        try:
+            summary = await self.__summarise(conversation)
+        except Exception as e:
+            logging.warning(f'Error while summarising chat history: {str(e)}. Popping elements instead...')
+            if self.history_generation.get(chat_id) == generation:
+                self.__truncate_history(chat_id, self.config['max_history_size'])
+                self.summary_floor[chat_id] = (len(self.conversations[chat_id]),
+                                               self.__count_conversation_tokens(chat_id))
+            return
+        if self.history_generation.get(chat_id) != generation:
+            logging.info(f'Chat history for chat ID {chat_id} changed while summarising. Discarding the summary...')
+            return
+
+        logging.debug(f'Summary: {summary}')
+        history = self.conversations[chat_id]
+        tokens = self.message_tokens[chat_id]
+        summary_message = {"role": "assistant", "name": SUMMARY_MESSAGE_NAME, "content": summary}
+        self.__set_history(chat_id, [history[0], summary_message] + history[summarised:],
+                           [tokens[0], self.__count_message_tokens(summary_message)] + tokens[summarised:])
+        self.summary_floor[chat_id] = (len(self.conversations[chat_id]), self.__count_conversation_tokens(chat_id))
 
     async def __summarise(self, conversation) -> str:
         """
@@ -616,9 +946,10 @@ class OpenAIHelper:
             {"role": "user", "content": str(conversation)}
         ]
         response = await self.client.chat.completions.create(
-            model=self.config['model'],
+            model=self.config['summary_model'],
             messages=messages,
-            temperature=0.4
+            temperature=0.4,
+            max_tokens=self.config['summary_max_tokens']
         )
         return response.choices[0].message.content
 
@@ -642,19 +973,24 @@ class OpenAIHelper:
             f"Max tokens for model {self.config['model']} is not implemented yet."
         )
 
+    def __count_conversation_tokens(self, chat_id) -> int:
+        """
+        Gets the number of tokens required to send the conversation history of a chat,
+        using the token counts kept when the messages were added.
+        :param chat_id: The chat ID
+        :return: the number of tokens required
+        """
+        return self.conversation_tokens[chat_id] + 3  # every reply is primed with <|start|>assistant<|message|>
+
     # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
-    def __count_tokens(self, messages) -> int:
+    def __count_message_tokens(self, message, image_tokens=None) -> int:
         """
-        Counts the number of tokens required to send the given messages.
-        :param messages: the messages to send
+        Counts the number of tokens a single message adds to a request.
+        :param message: the message
+        :param image_tokens: the number of tokens of the images in the message, if already known
         :return: the number of tokens required
         """
         model = self.config['model']
-        try:
-            encoding = tiktoken.encoding_for_model(model)
-        except KeyError:
-            encoding = tiktoken.get_encoding("gpt-3.5-turbo")
-
         if model in GPT_3_MODELS + GPT_3_16K_MODELS:
             tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
             tokens_per_name = -1  # if there's a name, the role is omitted
@@ -663,42 +999,44 @@ class OpenAIHelper:
             tokens_per_name = 1
         else:
             raise NotImplementedError(f"""num_tokens_from_messages() is not implemented for model {model}.""")
-        num_tokens = 0
-        for message in messages:
-            num_tokens += tokens_per_message
-            for key, value in message.items():
-                if key == 'content':
-                    if isinstance(value, str):
-                        num_tokens += len(encoding.encode(value))
-                    else:
-                        for message1 in value:
-                            if message1['type'] == 'image_url':
-                                image = decode_image(message1['image_url']['url'])
-                                num_tokens += self.__count_tokens_vision(image)
-                            else:
-                                num_tokens += len(encoding.encode(message1['text']))
-                else:
+        encoding = self.encoding
+        num_tokens = tokens_per_message
+        for key, value in message.items():
+            if key == 'content':
+                if isinstance(value, str):
                     num_tokens += len(encoding.encode(value))
-                    if key == "name":
-                        num_tokens += tokens_per_name
-        num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
+                else:
+                    if image_tokens is not None:
+                        num_tokens += image_tokens
+                    for message1 in value:
+                        if message1['type'] == 'image_url':
+                            if image_tokens is None:
+                                image = io.BytesIO(decode_image(message1['image_url']['url']))
+                                num_tokens += self.__count_tokens_vision(image)
+                        else:
+                            num_tokens += len(encoding.encode(message1['text']))
+            else:
+                num_tokens += len(encoding.encode(value))
+                if key == "name":
+                    num_tokens += tokens_per_name
         return num_tokens
 
-    # no longer needed
-
-    def __count_tokens_vision(self, image_bytes: bytes) -> int:
+    def __count_tokens_vision(self, fileobj) -> int:
         """
         Counts the number of tokens for interpreting an image.
-        :param image_bytes: image to interpret
+        Only the image header is read to get its size, the pixels are not decoded.
+        :param fileobj: image to interpret
         :return: the number of tokens required
         """
-        image_file = io.BytesIO(image_bytes)
-        image = Image.open(image_file)
+        position = fileobj.tell()
+        with Image.open(fileobj) as image:
+            size = image.size
+        fileobj.seek(position)
         model = self.config['vision_model']
-        if model not in GPT_4_VISION_MODELS:
+        if model not in GPT_VISION_TILE_MODELS:
             raise NotImplementedError(f"""count_tokens_vision() is not implemented for model {model}.""")
         
-        w, h = image.size
+        w, h = size
         if w > h: w, h = h, w
         # this computation follows https://platform.openai.com/docs/guides/vision and https://openai.com/pricing#gpt-4-turbo
         base_tokens = 85
@@ -58,7 +58,15 @@ class PluginManager:
         plugin = self.__get_plugin_by_function_name(function_name)
         if not plugin:
             return json.dumps({'error': f'Function {function_name} not found'})
-        return json.dumps(await plugin.execute(function_name, helper, **json.loads(arguments)), default=str)
+        response = await plugin.execute(function_name, helper, **json.loads(arguments))
+        if isinstance(response, dict) and 'direct_result' in response:
+            # direct results are sent to the user as they are, and may hold the content in memory
+            if response['direct_result'].get('format') == 'file_id':
+                # a cached file Telegram no longer accepts is generated again, see handle_direct_result
+                response['direct_result']['regenerate'] = \
+                    lambda: self.call_function(function_name, helper, arguments)
+            return response
+        return json.dumps(response, default=str)
 
     def get_plugin_source_name(self, function_name) -> str:
         """
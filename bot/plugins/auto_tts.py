@@ -1,5 +1,5 @@
 import datetime
-import tempfile
+import logging
 from typing import Dict
 
 from .plugin import Plugin
@@ -27,18 +27,21 @@ class AutoTextToSpeech(Plugin):
         }]
 
     async def execute(self, function_name, helper, **kwargs) -> Dict:
+        key = helper.speech_cache_key(kwargs['text'])
+        cached = await self.get_cached_direct_result(helper, 'file', key)
+        if cached is not None:
+            return cached
         try:
-            bytes, text_length = await helper.generate_speech(text=kwargs['text'])
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.opus') as temp_file:
-                temp_file.write(bytes.getvalue())
-                temp_file_path = temp_file.name
+            speech_file, text_length = await helper.generate_speech(text=kwargs['text'])
         except Exception as e:
             logging.exception(e)
             return {"Result": "Exception: " + str(e)}
         return {
             'direct_result': {
                 'kind': 'file',
-                'format': 'path',
-                'value': temp_file_path
+                'format': 'bytes',
+                'value': speech_file,
+                'filename': 'speech.opus',
+                'cache_key': key
             }
         }
@@ -1,8 +1,9 @@
-import datetime
+import io
 from typing import Dict
 
 from gtts import gTTS
 
+from cache import cache_key
 from .plugin import Plugin
 
 
@@ -32,13 +33,20 @@ class GTTSTextToSpeech(Plugin):
         }]
 
     async def execute(self, function_name, helper, **kwargs) -> Dict:
+        key = cache_key('gtts', kwargs['text'], kwargs.get('lang', 'en'))
+        cached = await self.get_cached_direct_result(helper, 'file', key)
+        if cached is not None:
+            return cached
         tts = gTTS(kwargs['text'], lang=kwargs.get('lang', 'en'))
-        output = f'gtts_{datetime.datetime.now().timestamp()}.mp3'
-        tts.save(output)
+        output = io.BytesIO()
+        tts.write_to_fp(output)
+        output.seek(0)
         return {
             'direct_result': {
                 'kind': 'file',
-                'format': 'path',
-                'value': output
+                'format': 'bytes',
+                'value': output,
+                'filename': 'gtts.mp3',
+                'cache_key': key
             }
         }
@@ -1,3 +1,5 @@
+from __future__ import annotations
+
 from abc import abstractmethod, ABC
 from typing import Dict
 
@@ -28,3 +30,25 @@ class Plugin(ABC):
         Execute the plugin and return a JSON serializable response
         """
         pass
+
+    @staticmethod
+    async def get_cached_direct_result(helper, kind: str, cache_key: str) -> Dict | None:
+        """
+        Gets a direct result sent before by the Telegram file_id of its upload, so that it is not
+        downloaded, generated or uploaded again. Direct results with a 'cache_key' are cached once sent.
+        :param helper: The OpenAI helper
+        :param kind: The kind of the direct result
+        :param cache_key: The key of the result's content, see cache.cache_key
+        :return: The direct result response, or None if it is not cached
+        """
+        file_id = await helper.direct_result_cache.get(cache_key)
+        if file_id is None:
+            return None
+        return {
+            'direct_result': {
+                'kind': kind,
+                'format': 'file_id',
+                'value': file_id,
+                'cache_key': cache_key
+            }
+        }
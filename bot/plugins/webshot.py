@@ -1,7 +1,11 @@
-import os, requests, random, string
+import requests
 from typing import Dict
+from cache import cache_key
 from .plugin import Plugin
 
+# Age in hours after which thum.io takes a new screenshot, cached screenshots expire with it
+MAX_AGE_HOURS = 12
+
 class WebshotPlugin(Plugin):
     """
     A plugin to screenshot a website
@@ -22,13 +26,14 @@ class WebshotPlugin(Plugin):
             },
         }]
     
-    def generate_random_string(self, length):
-        characters = string.ascii_letters + string.digits
-        return ''.join(random.choice(characters) for _ in range(length))
-
     async def execute(self, function_name, helper, **kwargs) -> Dict:
         try:
-            image_url = f'https://image.thum.io/get/maxAge/12/width/720/{kwargs["url"]}'
+            key = cache_key('webshot', kwargs['url'], MAX_AGE_HOURS)
+            cached = await self.get_cached_direct_result(helper, 'photo', key)
+            if cached is not None:
+                return cached
+
+            image_url = f'https://image.thum.io/get/maxAge/{MAX_AGE_HOURS}/width/720/{kwargs["url"]}'
             
             # preload url first
             requests.get(image_url)
@@ -37,24 +42,17 @@ class WebshotPlugin(Plugin):
             response = requests.get(image_url, timeout=30)
 
             if response.status_code == 200:
-                if not os.path.exists("uploads/webshot"):
-                    os.makedirs("uploads/webshot")
-
-                image_file_path = os.path.join("uploads/webshot", f"{self.generate_random_string(15)}.png")
-                with open(image_file_path, "wb") as f:
-                    f.write(response.content)
-
                 return {
                     'direct_result': {
                         'kind': 'photo',
-                        'format': 'path',
-                        'value': image_file_path
+                        'format': 'bytes',
+                        'value': response.content,
+                        'filename': 'webshot.png',
+                        'cache_key': key,
+                        'cache_ttl': MAX_AGE_HOURS * 3600
                     }
                 }
             else:
                 return {'result': 'Unable to screenshot website'}
         except:
-            if 'image_file_path' in locals():
-                os.remove(image_file_path)
-                
             return {'result': 'Unable to screenshot website'}
@@ -1,9 +1,11 @@
+import io
 import logging
 import re
 from typing import Dict
 
 from pytube import YouTube
 
+from cache import cache_key
 from .plugin import Plugin
 
 
@@ -32,14 +34,22 @@ class YouTubeAudioExtractorPlugin(Plugin):
         link = kwargs['youtube_link']
         try:
             video = YouTube(link)
+            key = cache_key('youtube_audio', video.video_id)
+            cached = await self.get_cached_direct_result(helper, 'file', key)
+            if cached is not None:
+                return cached
             audio = video.streams.filter(only_audio=True, file_extension='mp4').first()
-            output = re.sub(r'[^\w\-_\. ]', '_', video.title) + '.mp3'
-            audio.download(filename=output)
+            filename = re.sub(r'[^\w\-_\. ]', '_', video.title) + '.mp3'
+            output = io.BytesIO()
+            audio.stream_to_buffer(output)
+            output.seek(0)
             return {
                 'direct_result': {
                     'kind': 'file',
-                    'format': 'path',
-                    'value': output
+                    'format': 'bytes',
+                    'value': output,
+                    'filename': filename,
+                    'cache_key': key
                 }
             }
         except Exception as e:
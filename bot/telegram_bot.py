@@ -4,30 +4,32 @@ import asyncio
 import logging
 import os
 import io
+import shutil
 
-from bd import add_user
+from bd import known_users, iter_active_users_usage, is_admin_async, role_cache
 from uuid import uuid4
 from telegram import BotCommandScopeAllGroupChats, Update, constants
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton, InlineQueryResultArticle
 from telegram import InputTextMessageContent, BotCommand
 from telegram.error import RetryAfter, TimedOut, BadRequest
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, \
-    filters, InlineQueryHandler, CallbackQueryHandler, Application, ContextTypes, CallbackContext
+    filters, InlineQueryHandler, CallbackQueryHandler, ChatMemberHandler, Application, ContextTypes, CallbackContext
 
-from pydub import AudioSegment
-from PIL import Image
 
 from utils import is_group_chat, get_thread_id, message_text, wrap_with_indicator, split_into_chunks, \
-    edit_message_with_retry, get_stream_cutoff_values, is_allowed, get_remaining_budget, is_admin, is_within_budget, \
+    edit_message_with_retry, get_stream_cutoff_values, is_allowed, get_remaining_budget, is_within_budget, \
     get_reply_to_message_id, add_chat_request_to_usage_tracker, error_handler, is_direct_result, handle_direct_result, \
-    cleanup_intermediate_files
+    cleanup_intermediate_files, get_usage_tracker, group_membership_cache, track_chat_member, IdleSweeper
 from openai_helper import OpenAIHelper, localized_text
-from usage_tracker import UsageTracker
+from audio import AudioTranscoder
+from cache import PersistentLRUCache, cache_key
+from usage_tracker import UsageTracker, usage_flusher
 
 # Говно код ON
 def add_user_to_db(func):
     """
     Декоратор для автоматического добавления пользователя в базу данных перед выполнением команды.
+    Известные пользователи пропускаются без обращения к базе, новые добавляются в фоне пачками.
     """
     async def wrapper(self, update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
         user = update.message.from_user
@@ -35,7 +37,7 @@ def add_user_to_db(func):
         username = user.username
         first_name = user.first_name
         last_name = user.last_name
-        add_user(user_id, username, first_name, last_name)
+        known_users.add(user_id, username, first_name, last_name)
         return await func(self, update, context, *args, **kwargs)
     return wrapper
 
@@ -53,6 +55,13 @@ class ChatGPTTelegramBot:
         """
         self.config = config
         self.openai = openai
+        group_membership_cache.ttl = config['group_membership_cache_ttl']
+        self.transcoder = AudioTranscoder(max_processes=config['ffmpeg_max_processes'])
+        self.transcript_cache = PersistentLRUCache(
+            os.path.join(config['cache_dir'], 'transcripts.db') if config['cache_dir'] else None,
+            max_entries=config['transcript_cache_size'],
+            ttl=config['transcript_cache_ttl']
+        )
         bot_language = self.config['bot_language']
         self.commands = [
             BotCommand(command='help', description=localized_text('help_description', bot_language)),
@@ -67,6 +76,9 @@ class ChatGPTTelegramBot:
         if self.config.get('enable_tts_generation', False):
             self.commands.append(BotCommand(command='tts', description=localized_text('tts_description', bot_language)))
 
+        self.commands.append(BotCommand(command='reload_roles',
+                                        description=localized_text('reload_roles_description', bot_language)))
+
         self.group_commands = [BotCommand(
             command='chat', description=localized_text('chat_description', bot_language)
         )] + self.commands
@@ -75,7 +87,22 @@ class ChatGPTTelegramBot:
         self.usage = {}
         self.last_message = {}
         self.inline_queries_cache = {}
+        self.openai.conversation_sweeper.add_listener(lambda chat_id: self.last_message.pop(chat_id, None))
+        self.inline_query_sweeper = IdleSweeper(self.openai.conversation_sweeper.max_age,
+                                                lambda result_id: self.inline_queries_cache.pop(result_id, None))
       
+    def prewarm_usage(self, days: int):
+        """
+        Bulk-loads usage trackers of users active in the last `days` days with a single streaming query,
+        so the first messages after a restart don't each hit the database and the usage logs.
+        :param days: Number of days a user must have been active within to be loaded
+        """
+        loaded = 0
+        for user_id, user_name, usage_document in iter_active_users_usage(days):
+            self.usage[user_id] = UsageTracker(user_id, user_name or str(user_id), usage_document=usage_document)
+            loaded += 1
+        logging.info(f'Pre-warmed usage trackers for {loaded} users active in the last {days} days')
+
     @add_user_to_db
     async def help(self, update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
         """
@@ -112,8 +139,7 @@ class ChatGPTTelegramBot:
                      'requested their usage statistics')
 
         user_id = update.message.from_user.id
-        if user_id not in self.usage:
-            self.usage[user_id] = UsageTracker(user_id, update.message.from_user.name)
+        await get_usage_tracker(self.usage, user_id, update.message.from_user.name)
 
         tokens_today, tokens_month = self.usage[user_id].get_current_token_usage()
         images_today, images_month = self.usage[user_id].get_current_image_count()
@@ -124,8 +150,9 @@ class ChatGPTTelegramBot:
         current_cost = self.usage[user_id].get_current_cost()
 
         chat_id = update.effective_chat.id
+        await self.openai.ensure_conversation_loaded(chat_id)
         chat_messages, chat_token_length = self.openai.get_conversation_stats(chat_id)
-        remaining_budget = get_remaining_budget(self.config, self.usage, update)
+        remaining_budget = await get_remaining_budget(self.config, self.usage, update)
         bot_language = self.config['bot_language']
         
         text_current_conversation = (
@@ -204,6 +231,28 @@ class ChatGPTTelegramBot:
         usage_text = text_current_conversation + text_today + text_month + text_budget
         await update.message.reply_text(usage_text, parse_mode=constants.ParseMode.MARKDOWN)
 
+    async def reload_roles(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """
+        Clears the cached user roles, so role changes made in the database apply immediately (admins only).
+        Replies with the role cache hit ratio.
+        """
+        user_id = update.message.from_user.id
+        is_admin_user, _ = await is_admin_async(user_id)
+        if not is_admin_user:
+            logging.warning(f'User {update.message.from_user.name} (id: {user_id}) '
+                            'is not allowed to reload user roles')
+            await self.send_disallowed_message(update, context)
+            return
+
+        hits, misses, hit_ratio = role_cache.hits, role_cache.misses, role_cache.hit_ratio()
+        role_cache.invalidate()
+        logging.info(f'User roles cache cleared by admin {update.message.from_user.name} (id: {user_id})')
+        await update.effective_message.reply_text(
+            message_thread_id=get_thread_id(update),
+            text=f"{localized_text('roles_reloaded', self.config['bot_language'])}: "
+                 f"{hit_ratio:.1%} ({hits}/{hits + misses})"
+        )
+
     async def resend(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """
         Resend the last request
@@ -291,7 +340,7 @@ class ChatGPTTelegramBot:
                 user_id = update.message.from_user.id
                 self.usage[user_id].add_image_request(image_size, self.config['image_prices'])
                 # add guest chat request to guest usage tracker
-                if str(user_id) not in self.config['allowed_user_ids'].split(',') and 'guests' in self.usage:
+                if self.config['access_policy'].is_guest(user_id) and 'guests' in self.usage:
                     self.usage["guests"].add_image_request(image_size, self.config['image_prices'])
 
             except Exception as e:
@@ -326,19 +375,30 @@ class ChatGPTTelegramBot:
 
         async def _generate():
             try:
-                speech_file, text_length = await self.openai.generate_speech(text=tts_query)
-
-                await update.effective_message.reply_voice(
-                    reply_to_message_id=get_reply_to_message_id(self.config, update),
-                    voice=speech_file
-                )
-                speech_file.close()
-                # add image request to users usage tracker
+                # long text is sent in segments, each one as soon as it is synthesized.
+                # speech uploaded before is sent again by its file_id, without generating or uploading it
                 user_id = update.message.from_user.id
-                self.usage[user_id].add_tts_request(text_length, self.config['tts_model'], self.config['tts_prices'])
-                # add guest chat request to guest usage tracker
-                if str(user_id) not in self.config['allowed_user_ids'].split(',') and 'guests' in self.usage:
-                    self.usage["guests"].add_tts_request(text_length, self.config['tts_model'], self.config['tts_prices'])
+                index = 0
+                async for segment, voice, text_length in self.openai.generate_speech_segments(text=tts_query):
+                    message = await update.effective_message.reply_voice(
+                        reply_to_message_id=get_reply_to_message_id(self.config, update) if index == 0 else None,
+                        voice=voice
+                    )
+                    index += 1
+                    if isinstance(voice, str):
+                        continue
+                    voice.close()
+                    if message.voice is not None:
+                        self.openai.set_speech_file_id(segment, message.voice.file_id)
+                    if text_length == 0:
+                        # the speech was cached, nothing was generated
+                        continue
+                    # add image request to users usage tracker
+                    self.usage[user_id].add_tts_request(text_length, self.config['tts_model'], self.config['tts_prices'])
+                    # add guest chat request to guest usage tracker
+                    if self.config['access_policy'].is_guest(user_id) and 'guests' in self.usage:
+                        self.usage["guests"].add_tts_request(text_length, self.config['tts_model'],
+                                                             self.config['tts_prices'])
 
             except Exception as e:
                 logging.exception(e)
@@ -363,57 +423,79 @@ class ChatGPTTelegramBot:
             return
 
         chat_id = update.effective_chat.id
-        filename = update.message.effective_attachment.file_unique_id
+        attachment = update.message.effective_attachment
+        filename = attachment.file_unique_id
 
         async def _execute():
-            filename_mp3 = f'{filename}.mp3'
+            filename_audio = filename
+            segments_directory = f'{filename}_segments'
+            segments = None
             bot_language = self.config['bot_language']
-            try:
-                media_file = await context.bot.get_file(update.message.effective_attachment.file_id)
-                await media_file.download_to_drive(filename)
-            except Exception as e:
-                logging.exception(e)
-                await update.effective_message.reply_text(
-                    message_thread_id=get_thread_id(update),
-                    reply_to_message_id=get_reply_to_message_id(self.config, update),
-                    text=(
-                        f"{localized_text('media_download_fail', bot_language)[0]}: "
-                        f"{str(e)}. {localized_text('media_download_fail', bot_language)[1]}"
-                    ),
-                    parse_mode=constants.ParseMode.MARKDOWN
-                )
-                return
+            # forwarded copies of the same media share the file_unique_id, and are only transcribed once
+            transcript_key = cache_key(attachment.file_unique_id, self.openai.config['whisper_prompt'])
+            transcript = await self.transcript_cache.get(transcript_key)
+            if transcript is None:
+                try:
+                    media_file = await context.bot.get_file(attachment.file_id)
+                    await media_file.download_to_drive(filename)
+                except Exception as e:
+                    logging.exception(e)
+                    await update.effective_message.reply_text(
+                        message_thread_id=get_thread_id(update),
+                        reply_to_message_id=get_reply_to_message_id(self.config, update),
+                        text=(
+                            f"{localized_text('media_download_fail', bot_language)[0]}: "
+                            f"{str(e)}. {localized_text('media_download_fail', bot_language)[1]}"
+                        ),
+                        parse_mode=constants.ParseMode.MARKDOWN
+                    )
+                    return
 
-            try:
-                audio_track = AudioSegment.from_file(filename)
-                audio_track.export(filename_mp3, format="mp3")
-                logging.info(f'New transcribe request received from user {update.message.from_user.name} '
-                             f'(id: {update.message.from_user.id})')
+                try:
+                    # voice notes and other media report their duration, so the file is only probed otherwise
+                    duration_seconds = getattr(attachment, 'duration', None) or \
+                        await self.transcoder.probe_duration(filename)
+                    chunk_seconds = self.config['transcription_chunk_seconds']
+                    if chunk_seconds > 0 and duration_seconds > chunk_seconds:
+                        # long media is transcribed in segments split at pauses, concurrently
+                        segments = await self.transcoder.split(filename, duration_seconds, chunk_seconds,
+                                                               segments_directory)
+                    else:
+                        filename_audio = await self.transcoder.prepare(filename, getattr(attachment, 'mime_type', None))
+                    logging.info(f'New transcribe request received from user {update.message.from_user.name} '
+                                 f'(id: {update.message.from_user.id})')
 
-            except Exception as e:
-                logging.exception(e)
-                await update.effective_message.reply_text(
-                    message_thread_id=get_thread_id(update),
-                    reply_to_message_id=get_reply_to_message_id(self.config, update),
-                    text=localized_text('media_type_fail', bot_language)
-                )
-                if os.path.exists(filename):
-                    os.remove(filename)
-                return
+                except Exception as e:
+                    logging.exception(e)
+                    await update.effective_message.reply_text(
+                        message_thread_id=get_thread_id(update),
+                        reply_to_message_id=get_reply_to_message_id(self.config, update),
+                        text=localized_text('media_type_fail', bot_language)
+                    )
+                    if os.path.exists(filename):
+                        os.remove(filename)
+                    shutil.rmtree(segments_directory, ignore_errors=True)
+                    return
 
             user_id = update.message.from_user.id
-            if user_id not in self.usage:
-                self.usage[user_id] = UsageTracker(user_id, update.message.from_user.name)
+            await get_usage_tracker(self.usage, user_id, update.message.from_user.name)
 
             try:
-                transcript = await self.openai.transcribe(filename_mp3)
-
-                transcription_price = self.config['transcription_price']
-                self.usage[user_id].add_transcription_seconds(audio_track.duration_seconds, transcription_price)
+                is_guest = self.config['access_policy'].is_guest(user_id)
+                if transcript is not None:
+                    logging.info(f'Cached transcript found for user {update.message.from_user.name} '
+                                 f'(id: {update.message.from_user.id})')
+                else:
+                    if segments:
+                        transcript = await self.openai.transcribe_segments(segments)
+                    else:
+                        transcript = await self.openai.transcribe(filename_audio)
+                    self.transcript_cache.put(transcript_key, transcript)
 
-                allowed_user_ids = self.config['allowed_user_ids'].split(',')
-                if str(user_id) not in allowed_user_ids and 'guests' in self.usage:
-                    self.usage["guests"].add_transcription_seconds(audio_track.duration_seconds, transcription_price)
+                    transcription_price = self.config['transcription_price']
+                    self.usage[user_id].add_transcription_seconds(duration_seconds, transcription_price)
+                    if is_guest and 'guests' in self.usage:
+                        self.usage["guests"].add_transcription_seconds(duration_seconds, transcription_price)
 
                 # check if transcript starts with any of the prefixes
                 response_to_transcription = any(transcript.lower().startswith(prefix.lower()) if prefix else False
@@ -437,7 +519,7 @@ class ChatGPTTelegramBot:
                     response, total_tokens = await self.openai.get_chat_response(chat_id=chat_id, query=transcript)
 
                     self.usage[user_id].add_chat_tokens(total_tokens, self.config['token_price'])
-                    if str(user_id) not in allowed_user_ids and 'guests' in self.usage:
+                    if is_guest and 'guests' in self.usage:
                         self.usage["guests"].add_chat_tokens(total_tokens, self.config['token_price'])
 
                     # Split into chunks of 4096 characters (Telegram's message limit)
@@ -464,10 +546,11 @@ class ChatGPTTelegramBot:
                     parse_mode=constants.ParseMode.MARKDOWN
                 )
             finally:
-                if os.path.exists(filename_mp3):
-                    os.remove(filename_mp3)
+                if os.path.exists(filename_audio):
+                    os.remove(filename_audio)
                 if os.path.exists(filename):
                     os.remove(filename)
+                shutil.rmtree(segments_directory, ignore_errors=True)
 
         await wrap_with_indicator(update, context, _execute, constants.ChatAction.TYPING)
 
@@ -513,14 +596,10 @@ class ChatGPTTelegramBot:
                 )
                 return
             
-            # convert jpg from telegram to png as understood by openai
-
-            temp_file_png = io.BytesIO()
+            # downscale and re-encode the image for the vision model
 
             try:
-                original_image = Image.open(temp_file)
-                
-                original_image.save(temp_file_png, format='PNG')
+                vision_file = await self.openai.prepare_image(temp_file)
                 logging.info(f'New vision request received from user {update.message.from_user.name} '
                              f'(id: {update.message.from_user.id})')
 
@@ -531,16 +610,16 @@ class ChatGPTTelegramBot:
                     reply_to_message_id=get_reply_to_message_id(self.config, update),
                     text=localized_text('media_type_fail', bot_language)
                 )
+                return
             
             
 
             user_id = update.message.from_user.id
-            if user_id not in self.usage:
-                self.usage[user_id] = UsageTracker(user_id, update.message.from_user.name)
+            await get_usage_tracker(self.usage, user_id, update.message.from_user.name)
 
             if self.config['stream']:
 
-                stream_response = self.openai.interpret_image_stream(chat_id=chat_id, fileobj=temp_file_png, prompt=prompt)
+                stream_response = self.openai.interpret_image_stream(chat_id=chat_id, fileobj=vision_file, prompt=prompt)
                 i = 0
                 prev = ''
                 sent_message = None
@@ -549,7 +628,8 @@ class ChatGPTTelegramBot:
 
                 async for content, tokens in stream_response:
                     if is_direct_result(content):
-                        return await handle_direct_result(self.config, update, content)
+                        return await handle_direct_result(self.config, update, content,
+                                                          self.openai.direct_result_cache)
 
                     if len(content.strip()) == 0:
                         continue
@@ -621,7 +701,7 @@ class ChatGPTTelegramBot:
             else:
 
                 try:
-                    interpretation, total_tokens = await self.openai.interpret_image(chat_id, temp_file_png, prompt=prompt)
+                    interpretation, total_tokens = await self.openai.interpret_image(chat_id, vision_file, prompt=prompt)
 
 
                     try:
@@ -657,8 +737,7 @@ class ChatGPTTelegramBot:
             vision_token_price = self.config['vision_token_price']
             self.usage[user_id].add_vision_tokens(total_tokens, vision_token_price)
 
-            allowed_user_ids = self.config['allowed_user_ids'].split(',')
-            if str(user_id) not in allowed_user_ids and 'guests' in self.usage:
+            if self.config['access_policy'].is_guest(user_id) and 'guests' in self.usage:
                 self.usage["guests"].add_vision_tokens(total_tokens, vision_token_price)
 
         await wrap_with_indicator(update, context, _execute, constants.ChatAction.TYPING)
@@ -680,6 +759,7 @@ class ChatGPTTelegramBot:
         user_id = update.message.from_user.id
         prompt = message_text(update.message)
         self.last_message[chat_id] = prompt
+        self.openai.conversation_sweeper.touch(chat_id)
 
         if is_group_chat(update):
             trigger_keyword = self.config['group_trigger_keyword']
@@ -717,7 +797,8 @@ class ChatGPTTelegramBot:
 
                 async for content, tokens in stream_response:
                     if is_direct_result(content):
-                        return await handle_direct_result(self.config, update, content)
+                        return await handle_direct_result(self.config, update, content,
+                                                          self.openai.direct_result_cache)
 
                     if len(content.strip()) == 0:
                         continue
@@ -791,7 +872,8 @@ class ChatGPTTelegramBot:
                     response, total_tokens = await self.openai.get_chat_response(chat_id=chat_id, query=prompt)
 
                     if is_direct_result(response):
-                        return await handle_direct_result(self.config, update, response)
+                        return await handle_direct_result(self.config, update, response,
+                                                          self.openai.direct_result_cache)
 
                     # Split into chunks of 4096 characters (Telegram's message limit)
                     chunks = split_into_chunks(response)
@@ -842,6 +924,7 @@ class ChatGPTTelegramBot:
         callback_data_suffix = "gpt:"
         result_id = str(uuid4())
         self.inline_queries_cache[result_id] = query
+        self.inline_query_sweeper.touch(result_id)
         callback_data = f'{callback_data_suffix}{result_id}'
 
         await self.send_inline_query_result(update, result_id, message_content=query, callback_data=callback_data)
@@ -1024,7 +1107,7 @@ class ChatGPTTelegramBot:
             logging.warning(f'User {name} (id: {user_id}) is not allowed to use the bot')
             await self.send_disallowed_message(update, context, is_inline)
             return False
-        if not is_within_budget(self.config, self.usage, update, is_inline=is_inline):
+        if not await is_within_budget(self.config, self.usage, update, is_inline=is_inline):
             logging.warning(f'User {name} (id: {user_id}) reached their usage limit')
             await self.send_budget_reached_message(update, context, is_inline)
             return False
@@ -1064,6 +1147,26 @@ class ChatGPTTelegramBot:
         """
         await application.bot.set_my_commands(self.group_commands, scope=BotCommandScopeAllGroupChats())
         await application.bot.set_my_commands(self.commands)
+        usage_flusher.start(interval=self.config['usage_flush_interval'],
+                            max_pending=self.config['usage_flush_max_pending'])
+        await known_users.start(interval=self.config['new_users_flush_interval'])
+        self.openai.conversation_sweeper.start(self.config['conversation_sweep_interval'], 'conversations')
+        self.inline_query_sweeper.start(self.config['conversation_sweep_interval'], 'inline queries')
+
+    async def post_shutdown(self, _: Application) -> None:
+        """
+        Shutdown hook for the bot. Persists usage data and conversation writes still held in memory.
+        """
+        await usage_flusher.stop()
+        await known_users.stop()
+        await self.openai.conversation_sweeper.stop()
+        await self.inline_query_sweeper.stop()
+        await asyncio.get_running_loop().run_in_executor(None, self.openai.conversation_store.close)
+        await asyncio.get_running_loop().run_in_executor(None, self.transcript_cache.close)
+        await asyncio.get_running_loop().run_in_executor(None, self.openai.speech_file_ids.close)
+        await asyncio.get_running_loop().run_in_executor(None, self.openai.direct_result_cache.close)
+        if self.openai.speech_cache is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self.openai.speech_cache.close)
 
     def run(self):
         """
@@ -1074,6 +1177,7 @@ class ChatGPTTelegramBot:
             .proxy_url(self.config['proxy']) \
             .get_updates_proxy_url(self.config['proxy']) \
             .post_init(self.post_init) \
+            .post_shutdown(self.post_shutdown) \
             .concurrent_updates(True) \
             .build()
 
@@ -1084,6 +1188,7 @@ class ChatGPTTelegramBot:
         application.add_handler(CommandHandler('start', self.help))
         application.add_handler(CommandHandler('stats', self.stats))
         application.add_handler(CommandHandler('resend', self.resend))
+        application.add_handler(CommandHandler('reload_roles', self.reload_roles))
         application.add_handler(CommandHandler(
             'chat', self.prompt, filters=filters.ChatType.GROUP | filters.ChatType.SUPERGROUP)
         )
@@ -1100,7 +1205,9 @@ class ChatGPTTelegramBot:
             constants.ChatType.GROUP, constants.ChatType.SUPERGROUP, constants.ChatType.PRIVATE
         ]))
         application.add_handler(CallbackQueryHandler(self.handle_callback_inline_query))
+        application.add_handler(ChatMemberHandler(track_chat_member, ChatMemberHandler.ANY_CHAT_MEMBER))
 
         application.add_error_handler(error_handler)
 
-        application.run_polling()
+        # chat_member updates are only delivered when requested explicitly
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
@@ -1,8 +1,12 @@
+import asyncio
+import logging
 import os.path
 import pathlib
 import json
+import threading
 from datetime import date
-from bd import save_to_database, get_user_usage
+from bd import HISTORY_UPSERTS, build_usage_rows, save_to_database_in_background, save_usage_batch_async, \
+    get_user_usage, run_in_db_executor
 
 def year_month(date_str):
     # извлекаем строку года-месяца из даты, например: '2023-03'
@@ -13,6 +17,33 @@ def save_usage_to_cash(user_file, usage):
   with open(user_file, "w") as outfile:
       json.dump(usage, outfile)
 
+def format_usage_document(user_name, usage_document):
+    """
+    Преобразует документ использования из базы данных в формат UsageTracker.
+    :param user_name: Имя пользователя в Telegram
+    :param usage_document: Документ {"current_cost": {...}, "usage_history": {...}} из get_user_usage
+    """
+    current_cost = usage_document["current_cost"]
+    history = usage_document["usage_history"]
+    return {
+        "user_name": user_name,  # Использует переданный user_name
+        "current_cost": {
+            "day": float(current_cost["day"]),
+            "month": float(current_cost["month"]),
+            "all_time": float(current_cost["all_time"]),
+            "last_update": str(date.today())
+        },
+        "usage_history": {
+            "chat_tokens": dict(history["chat_tokens"]),
+            "transcription_seconds": {day: float(seconds) for day, seconds in history["transcription_seconds"].items()},
+            "number_images": {day: [int(images[0]), int(images[1]), int(images[2])]
+                              for day, images in history["number_images"].items()},
+            "tts_characters": {},
+            "vision_tokens": {}
+        }
+    }
+
+
 class UsageTracker:
     """
     Класс UsageTracker
@@ -44,50 +75,47 @@ class UsageTracker:
     }
     """
 
-    def __init__(self, user_id, user_name, logs_dir="usage_logs"):
+    def __init__(self, user_id, user_name, logs_dir="usage_logs", usage_document=None):
       """
       Инициализирует объект UsageTracker для пользователя с текущей датой.
       Загружает данные использования из файла журнала использования.
       :param user_id: ID пользователя в Telegram
       :param user_name: Имя пользователя в Telegram
       :param logs_dir: Путь к директории с журналами использования, по умолчанию "usage_logs"
+      :param usage_document: Уже загруженный документ использования (например, из iter_active_users_usage),
+                             чтобы не обращаться к базе данных (пустой словарь - в базе данных пользователя нет)
       """
       self.user_id = user_id
       self.logs_dir = logs_dir
       # Путь к файлу использования для данного пользователя
       self.user_file = f"{logs_dir}/{user_id}.json"
+      # Изменённые с последнего сохранения ячейки истории в виде пар (метрика, дата)
+      self.dirty_cells = set()
 
-      if not self.load_usage_from_database(user_name):
+      if not self.load_usage_from_database(user_name, usage_document):
           self.load_usage_from_cache(user_name)
 
-    def load_usage_from_database(self, user_name):
-        """Загружает данные использования из базы данных и сохраняет их в атрибут usage."""
-        # Получаем данные использования из базы данных
-        user_data = get_user_usage(self.user_id)
-        if user_data:
-            # Преобразуем данные в нужный формат
-            current_cost, chat_tokens_history, transcription_seconds_history, number_images_history = user_data
-            if current_cost:
-                formatted_data = {
-                    "user_name": user_name,  # Использует переданный user_name
-                    "current_cost": {
-                        "day": float(current_cost[1]),
-                        "month": float(current_cost[2]),
-                        "all_time": float(current_cost[3]),
-                        "last_update": str(date.today())
-                    },
-                    "usage_history": {
-                        "chat_tokens": {str(row[1]): row[2] for row in chat_tokens_history},
-                        "transcription_seconds": {str(row[1]): float(row[2]) for row in transcription_seconds_history},
-                        "number_images": {str(row[1]): [int(row[2][0]), int(row[2][1]), int(row[2][2])] for row in number_images_history},
-                        "tts_characters": {},
-                        "vision_tokens": {}
-                    }
-                }
-                self.usage = formatted_data
-                return True
+    @classmethod
+    async def create(cls, user_id, user_name, logs_dir="usage_logs", usage_document=None):
+      """
+      Создаёт UsageTracker в пуле потоков базы данных, не блокируя цикл событий.
+      Параметры совпадают с __init__.
+      """
+      return await run_in_db_executor(cls, user_id, user_name, logs_dir, usage_document)
+
+    def load_usage_from_database(self, user_name, usage_document=None):
+        """
+        Загружает данные использования из базы данных и сохраняет их в атрибут usage.
+        :param usage_document: Уже загруженный документ использования (например, пакетной загрузкой),
+                               если не указан - загружается из базы данных
+        """
+        if usage_document is None:
+            usage_document = get_user_usage(self.user_id)
+        if usage_document:
+            self.usage = format_usage_document(user_name, usage_document)
+            return True
         return False
-  
+
     def load_usage_from_cache(self, user_name):
       """Загружает данные использования из файла журнала использования."""
       if os.path.isfile(self.user_file):
@@ -97,6 +125,9 @@ class UsageTracker:
               self.usage['usage_history']['vision_tokens'] = {}
           if 'tts_characters' not in self.usage['usage_history']:
               self.usage['usage_history']['tts_characters'] = {}
+          # Истории из файла может не быть в базе данных, поэтому при следующем сохранении пишем её целиком
+          for metric in HISTORY_UPSERTS:
+              self.dirty_cells.update((metric, day) for day in self.usage['usage_history'][metric])
       else:
           # Убедимся, что директория существует
           pathlib.Path(self.logs_dir).mkdir(exist_ok=True)
@@ -106,11 +137,30 @@ class UsageTracker:
               "current_cost": {"day": 0.0, "month": 0.0, "all_time": 0.0, "last_update": str(date.today())},
               "usage_history": {"chat_tokens": {}, "transcription_seconds": {}, "number_images": {}, "tts_characters": {}, "vision_tokens": {}}
           }
-          # Сохраняем новые данные использования в файл пользователя
-          save_usage_to_cash(self.user_file, self.usage)
-          # Сохраняем данные в базу данных
-          save_to_database(self.user_id, self.usage)
+          # Сохраняем изменения в файл пользователя и базу данных
+          self.save_usage()
   
+    def save_usage(self):
+      """
+      Сохраняет данные использования в файл пользователя, а в базу данных -
+      current_cost и только изменённые с прошлого сохранения ячейки истории.
+      """
+      if usage_flusher.running:
+          # Изменения запишет фоновый накопитель вместе с изменениями других пользователей
+          usage_flusher.mark_dirty(self)
+          return
+      save_usage_to_cash(self.user_file, self.usage)
+      save_to_database_in_background(self.user_id, self.usage, self.dirty_cells)
+      self.dirty_cells = set()
+
+    def take_changes(self):
+      """
+      Забирает накопленные изменения для фоновой записи.
+      :return: Изменённые ячейки истории и содержимое файла кэша
+      """
+      dirty_cells, self.dirty_cells = self.dirty_cells, set()
+      return dirty_cells, json.dumps(self.usage)
+
     # Функции использования токенов:
   
     def add_chat_tokens(self, tokens, tokens_price=0.002):
@@ -126,11 +176,10 @@ class UsageTracker:
       else:
           # Создаем новую запись для текущей даты
           self.usage["usage_history"]["chat_tokens"][str(today)] = tokens
+      self.dirty_cells.add(("chat_tokens", str(today)))
   
-      # Сохраняем обновленное использование токенов в файл пользователя
-      save_usage_to_cash(self.user_file, self.usage)
-      # Сохраняем данные в базу данных
-      save_to_database(self.user_id, self.usage)
+      # Сохраняем изменения в файл пользователя и базу данных
+      self.save_usage()
 
     def get_current_token_usage(self):
         """Получить количество токенов, использованных за сегодня и за месяц
@@ -172,11 +221,10 @@ class UsageTracker:
             # create new entry for current date
             self.usage["usage_history"]["number_images"][str(today)] = [0, 0, 0]
             self.usage["usage_history"]["number_images"][str(today)][requested_size] += 1
+        self.dirty_cells.add(("number_images", str(today)))
 
-        # Сохраняем новые данные использования в файл пользователя
-        save_usage_to_cash(self.user_file, self.usage)
-        # Сохраняем данные в базу данных
-        save_to_database(self.user_id, self.usage)
+        # Сохраняем изменения в файл пользователя и базу данных
+        self.save_usage()
 
     def get_current_image_count(self):
         """Получите количество изображений, запрошенных за сегодня и за месяц.
@@ -215,10 +263,8 @@ class UsageTracker:
             # create new entry for current date
             self.usage["usage_history"]["vision_tokens"][str(today)] = tokens
 
-        # Сохраняем новые данные использования в файл пользователя
-        save_usage_to_cash(self.user_file, self.usage)
-        # Сохраняем данные в базу данных
-        save_to_database(self.user_id, self.usage)
+        # Сохраняем изменения в файл пользователя и базу данных
+        self.save_usage()
       
     def get_current_vision_tokens(self):
         """Get vision tokens for today and this month.
@@ -260,10 +306,8 @@ class UsageTracker:
             # create new entry for current date
             self.usage["usage_history"]["tts_characters"][tts_model][str(today)] = text_length
 
-        # Сохраняем новые данные использования в файл пользователя
-        save_usage_to_cash(self.user_file, self.usage)
-        # Сохраняем данные в базу данных
-        save_to_database(self.user_id, self.usage)
+        # Сохраняем изменения в файл пользователя и базу данных
+        self.save_usage()
 
     def get_current_tts_usage(self):
         """Get length of speech generated for today and this month.
@@ -307,11 +351,10 @@ class UsageTracker:
         else:
             # create new entry for current date
             self.usage["usage_history"]["transcription_seconds"][str(today)] = seconds
+        self.dirty_cells.add(("transcription_seconds", str(today)))
 
-        # Сохраняем новые данные использования в файл пользователя
-        save_usage_to_cash(self.user_file, self.usage)
-        # Сохраняем данные в базу данных
-        save_to_database(self.user_id, self.usage)
+        # Сохраняем изменения в файл пользователя и базу данных
+        self.save_usage()
 
     def add_current_costs(self, request_cost):
       """
@@ -411,3 +454,122 @@ class UsageTracker:
 
         all_time_cost = token_cost + transcription_cost + image_cost + vision_cost + tts_cost
         return all_time_cost
+
+
+class UsageFlusher:
+    """
+    Фоновая запись данных использования (write-behind).
+    Трекеры только помечают себя изменёнными, а фоновая задача раз в interval секунд
+    (или раньше, когда изменённых трекеров набирается max_pending) записывает изменения
+    всех пользователей одной транзакцией в базу данных и обновляет файлы кэша.
+    interval ограничивает объём данных, теряемых при аварийном завершении.
+    """
+
+    def __init__(self):
+        self.interval = 5.0
+        self.max_pending = 100
+        self._pending = {}  # {user_id: UsageTracker}
+        self._lock = threading.Lock()
+        self._flush_lock = None
+        self._wakeup = None
+        self._loop = None
+        self._task = None
+        self._stopping = False
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def start(self, interval=5.0, max_pending=100):
+        """
+        Запускает фоновую запись. Вызывается из работающего цикла событий.
+        :param interval: Максимальный интервал между записями в секундах
+        :param max_pending: Количество изменённых трекеров, при котором запись начинается досрочно
+        """
+        self.interval = interval
+        self.max_pending = max_pending
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._stopping = False
+        self._task = self._loop.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает фоновую запись и сохраняет всё, что осталось в памяти."""
+        if self._task is None:
+            return
+        task, self._task = self._task, None
+        # задача не отменяется: отмена посреди flush() потеряла бы уже забранные изменения,
+        # вместо этого цикл завершается после последней записи
+        self._stopping = True
+        self._wakeup.set()
+        await task
+        await self.flush()
+
+    def mark_dirty(self, tracker):
+        """Помечает трекер изменённым. Можно вызывать из любого потока."""
+        with self._lock:
+            self._pending[tracker.user_id] = tracker
+            pending_count = len(self._pending)
+        if pending_count >= self.max_pending and self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.exception(e)
+
+    async def flush(self):
+        """Записывает накопленные изменения всех пользователей."""
+        async with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return
+
+            cache_files = []
+            cost_rows = []
+            history_rows = {metric: [] for metric in HISTORY_UPSERTS}
+            changes = []
+            for tracker in pending.values():
+                dirty_cells, cache_content = tracker.take_changes()
+                cache_files.append((tracker.user_file, cache_content))
+                # трекер гостей хранится только в файле кэша
+                if not isinstance(tracker.user_id, int):
+                    continue
+                cost_row, rows = build_usage_rows(tracker.user_id, tracker.usage, dirty_cells)
+                cost_rows.append(cost_row)
+                for metric, metric_rows in rows.items():
+                    history_rows[metric].extend(metric_rows)
+                changes.append((tracker, dirty_cells))
+
+            await asyncio.get_running_loop().run_in_executor(None, write_cache_files, cache_files)
+            if cost_rows and not await save_usage_batch_async(cost_rows, history_rows):
+                # вернём изменения, чтобы записать их при следующей попытке
+                for tracker, dirty_cells in changes:
+                    tracker.dirty_cells |= dirty_cells
+                    self.mark_dirty(tracker)
+                logging.warning(f'Не удалось сохранить данные использования {len(changes)} пользователей, '
+                                'повторим при следующей записи')
+
+
+def write_cache_files(cache_files):
+    """Записывает подготовленное содержимое файлов кэша использования."""
+    for user_file, content in cache_files:
+        try:
+            pathlib.Path(user_file).parent.mkdir(exist_ok=True)
+            with open(user_file, "w") as outfile:
+                outfile.write(content)
+        except OSError as e:
+            logging.warning(f'Не удалось сохранить файл использования {user_file}: {str(e)}')
+
+
+# Общий накопитель изменений для всех трекеров процесса
+usage_flusher = UsageFlusher()
@@ -1,14 +1,20 @@
 from __future__ import annotations
 
 import asyncio
+import heapq
 import itertools
 import json
 import logging
+import io
 import os
+import re
+import time
 import base64
+from concurrent.futures import ThreadPoolExecutor
 
 import telegram
-from bd import  is_admin
+from PIL import Image
+from bd import is_admin_async
 from telegram import Message, MessageEntity, Update, ChatMember, constants
 from telegram.ext import CallbackContext, ContextTypes
 
@@ -34,16 +40,205 @@ async def is_user_in_group(update: Update, context: CallbackContext, user_id: in
     """
     Checks if user_id is a member of the group
     """
+    chat_id = update.message.chat_id
     try:
-        chat_member = await context.bot.get_chat_member(update.message.chat_id, user_id)
-        return chat_member.status in [ChatMember.OWNER, ChatMember.ADMINISTRATOR, ChatMember.MEMBER]
+        chat_member = await context.bot.get_chat_member(chat_id, user_id)
+        is_member = is_member_status(chat_member)
     except telegram.error.BadRequest as e:
         if str(e) == "User not found":
-            return False
+            is_member = False
         else:
             raise e
     except Exception as e:
         raise e
+    group_membership_cache.put(chat_id, user_id, is_member)
+    return is_member
+
+
+def is_member_status(chat_member: ChatMember) -> bool:
+    """
+    Checks if the chat member status counts as group membership
+    """
+    return chat_member.status in [ChatMember.OWNER, ChatMember.ADMINISTRATOR, ChatMember.MEMBER]
+
+
+class GroupMembershipCache:
+    """
+    Caches group membership of authorized users per (chat_id, user_id) for a limited time,
+    so that group chat messages don't query the Bot API for every authorized user.
+    Entries are also updated from chat_member updates.
+    """
+
+    def __init__(self, ttl=300.0):
+        """
+        :param ttl: Time in seconds after which a cached membership is checked again
+        """
+        self.ttl = ttl
+        self._entries = {}  # {(chat_id, user_id): (expires_at, is_member)}
+
+    def get(self, chat_id: int, user_id: int) -> bool | None:
+        """
+        Returns the cached membership, or None if it is unknown or expired
+        """
+        entry = self._entries.get((chat_id, user_id))
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._entries[(chat_id, user_id)]
+            return None
+        return entry[1]
+
+    def put(self, chat_id: int, user_id: int, is_member: bool):
+        self._entries[(chat_id, user_id)] = (time.monotonic() + self.ttl, is_member)
+
+    def invalidate_chat(self, chat_id: int):
+        """
+        Drops all cached memberships of a chat
+        """
+        for key in [key for key in self._entries if key[0] == chat_id]:
+            del self._entries[key]
+
+
+group_membership_cache = GroupMembershipCache()
+
+
+class IdleSweeper:
+    """
+    Evicts entries that have been idle for longer than max_age seconds.
+    Activity is kept in a min-heap ordered by last activity. Entries touched again
+    stay in the heap with their old time and are skipped when popped (lazy deletion).
+    """
+
+    def __init__(self, max_age: float, on_evict=None):
+        """
+        :param max_age: Time in seconds without activity after which an entry is evicted
+        :param on_evict: Callback receiving the key of an evicted entry
+        """
+        self.max_age = max_age
+        self.evicted = 0
+        self._listeners = [on_evict] if on_evict is not None else []
+        self._last_seen = {}  # {key: last activity}
+        self._heap = []  # [(last activity, sequence, key)]
+        self._sequence = itertools.count()
+        self._task = None
+
+    @property
+    def resident(self) -> int:
+        """
+        The number of entries currently tracked
+        """
+        return len(self._last_seen)
+
+    def add_listener(self, on_evict):
+        self._listeners.append(on_evict)
+
+    def touch(self, key):
+        """
+        Records activity of an entry
+        """
+        now = time.monotonic()
+        self._last_seen[key] = now
+        heapq.heappush(self._heap, (now, next(self._sequence), key))
+        # drop the skipped heap items once they outnumber the live ones
+        if len(self._heap) > 4 * len(self._last_seen) + 64:
+            self._heap = [(last_seen, next(self._sequence), key) for key, last_seen in self._last_seen.items()]
+            heapq.heapify(self._heap)
+
+    def sweep(self) -> int:
+        """
+        Evicts all entries idle for longer than max_age.
+        :return: The number of evicted entries
+        """
+        deadline = time.monotonic() - self.max_age
+        evicted = 0
+        while self._heap and self._heap[0][0] <= deadline:
+            last_seen, _, key = heapq.heappop(self._heap)
+            if self._last_seen.get(key) != last_seen:
+                continue
+            del self._last_seen[key]
+            for on_evict in self._listeners:
+                try:
+                    on_evict(key)
+                except Exception as e:
+                    logging.warning(f'Failed to evict idle entry {key}: {str(e)}')
+            evicted += 1
+        self.evicted += evicted
+        return evicted
+
+    def start(self, interval: float, name: str):
+        """
+        Starts sweeping in the background. Must be called from the running event loop.
+        :param interval: Time in seconds between sweeps
+        :param name: Name of the swept entries used in log messages
+        """
+        self._task = asyncio.get_running_loop().create_task(self._run(interval, name))
+
+    async def stop(self):
+        if self._task is None:
+            return
+        task, self._task = self._task, None
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    async def _run(self, interval, name):
+        while True:
+            await asyncio.sleep(interval)
+            evicted = self.sweep()
+            if evicted:
+                logging.info(f'Evicted {evicted} idle {name}, {self.resident} resident, '
+                             f'{self.evicted} evicted in total')
+
+
+async def track_chat_member(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Updates the group membership cache from chat_member and my_chat_member updates.
+    """
+    chat_member_update = update.chat_member or update.my_chat_member
+    if chat_member_update is None:
+        return
+    chat_id = chat_member_update.chat.id
+    new_chat_member = chat_member_update.new_chat_member
+    if update.my_chat_member is not None and not is_member_status(new_chat_member):
+        # the bot itself left the chat, nothing cached for it is relevant anymore
+        group_membership_cache.invalidate_chat(chat_id)
+        return
+    group_membership_cache.put(chat_id, new_chat_member.user.id, is_member_status(new_chat_member))
+
+
+async def is_any_user_in_group(update: Update, context: CallbackContext, user_ids) -> int | None:
+    """
+    Checks if any of the given users is a member of the group.
+    Cached memberships are checked first, the remaining users are looked up concurrently
+    and the lookup stops at the first member found.
+    :return: The id of a member, or None if none of the users is in the group
+    """
+    chat_id = update.message.chat_id
+    unknown_user_ids = []
+    for user_id in user_ids:
+        is_member = group_membership_cache.get(chat_id, user_id)
+        if is_member:
+            return user_id
+        if is_member is None:
+            unknown_user_ids.append(user_id)
+    if not unknown_user_ids:
+        return None
+
+    async def lookup(user_id):
+        return user_id, await is_user_in_group(update, context, user_id)
+
+    tasks = [asyncio.create_task(lookup(user_id)) for user_id in unknown_user_ids]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            user_id, is_member = await next_done
+            if is_member:
+                return user_id
+        return None
+    finally:
+        for task in tasks:
+            task.cancel()
 
 
 def get_thread_id(update: Update) -> int | None:
@@ -86,6 +281,26 @@ def split_into_chunks(text: str, chunk_size: int = 4096) -> list[str]:
     return [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
 
 
+def split_into_sentence_chunks(text: str, chunk_size: int) -> list[str]:
+    """
+    Splits a string at sentence boundaries into chunks of whole sentences of at most a given size.
+    A sentence longer than the chunk size is a chunk of its own.
+    """
+    chunks = []
+    chunk = ''
+    for sentence in re.split(r'(?<=[.!?…。！？])\s+|\n+', text.strip()):
+        if not sentence:
+            continue
+        if chunk and len(chunk) + 1 + len(sentence) > chunk_size:
+            chunks.append(chunk)
+            chunk = sentence
+        else:
+            chunk = f'{chunk} {sentence}' if chunk else sentence
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
 async def wrap_with_indicator(update: Update, context: CallbackContext, coroutine,
                               chat_action: constants.ChatAction = "", is_inline=False):
     """
@@ -153,26 +368,23 @@ async def is_allowed(config, update: Update, context: CallbackContext, is_inline
     """
     Checks if the user is allowed to use the bot.
     """
-    if config['allowed_user_ids'] == '*':
+    policy = config['access_policy']
+    if policy.allow_all:
         return True
 
     user_id = update.inline_query.from_user.id if is_inline else update.message.from_user.id
-    if is_admin(user_id):
+    if (await is_admin_async(user_id))[0]:
         return True
     name = update.inline_query.from_user.name if is_inline else update.message.from_user.name
-    allowed_user_ids = config['allowed_user_ids'].split(',')
     # Check if user is allowed
-    if str(user_id) in allowed_user_ids:
+    if policy.is_allowed_user(user_id):
         return True
     # Check if it's a group a chat with at least one authorized member
     if not is_inline and is_group_chat(update):
-        admin_user_ids = config['admin_user_ids'].split(',')
-        for user in itertools.chain(allowed_user_ids, admin_user_ids):
-            if not user.strip():
-                continue
-            if await is_user_in_group(update, context, user):
-                logging.info(f'{user} is a member. Allowing group chat message...')
-                return True
+        user = await is_any_user_in_group(update, context, policy.group_member_ids)
+        if user is not None:
+            logging.info(f'{user} is a member. Allowing group chat message...')
+            return True
         logging.info(f'Group chat messages from user {name} '
                      f'(id: {user_id}) are not allowed')
     return False
@@ -197,7 +409,7 @@ async def is_allowed(config, update: Update, context: CallbackContext, is_inline
 #    return False
 
 
-def get_user_budget(config, user_id) -> float | None:
+async def get_user_budget(config, user_id) -> float | None:
     """
     Get the user's budget based on their user ID and the bot configuration.
     :param config: The bot configuration object
@@ -206,28 +418,28 @@ def get_user_budget(config, user_id) -> float | None:
     """
 
     # no budget restrictions for admins and '*'-budget lists
-    if is_admin(user_id) or config['user_budgets'] == '*':
+    policy = config['access_policy']
+    if policy.unlimited_budgets or (await is_admin_async(user_id))[0]:
         return float('inf')
+    return policy.budget_for(user_id)
 
-    user_budgets = config['user_budgets'].split(',')
-    if config['allowed_user_ids'] == '*':
-        # same budget for all users, use value in first position of budget list
-        if len(user_budgets) > 1:
-            logging.warning('multiple values for budgets set with unrestricted user list '
-                            'only the first value is used as budget for everyone.')
-        return float(user_budgets[0])
-
-    allowed_user_ids = config['allowed_user_ids'].split(',')
-    if str(user_id) in allowed_user_ids:
-        user_index = allowed_user_ids.index(str(user_id))
-        if len(user_budgets) <= user_index:
-            logging.warning(f'No budget set for user id: {user_id}. Budget list shorter than user list.')
-            return 0.0
-        return float(user_budgets[user_index])
-    return None
+
+async def get_usage_tracker(usage, user_id, user_name) -> UsageTracker:
+    """
+    Возвращает трекер использования пользователя, при необходимости загружая его без блокировки цикла событий.
+    :param usage: Словарь трекеров использования
+    :param user_id: Идентификатор пользователя (или 'guests')
+    :param user_name: Имя пользователя
+    :return: Объект трекера использования
+    """
+    if user_id not in usage:
+        tracker = await UsageTracker.create(user_id, user_name)
+        # пока трекер загружался, его мог создать параллельный запрос того же пользователя
+        usage.setdefault(user_id, tracker)
+    return usage[user_id]
 
 
-def get_remaining_budget(config, usage, update: Update, is_inline=False) -> float:
+async def get_remaining_budget(config, usage, update: Update, is_inline=False) -> float:
     """
     Рассчитать оставшийся бюджет для пользователя на основе их текущего использования.
     :param config: Объект конфигурации бота
@@ -245,24 +457,22 @@ def get_remaining_budget(config, usage, update: Update, is_inline=False) -> floa
 
     user_id = update.inline_query.from_user.id if is_inline else update.message.from_user.id
     name = update.inline_query.from_user.name if is_inline else update.message.from_user.name
-    if user_id not in usage:
-        usage[user_id] = UsageTracker(user_id, name)
+    await get_usage_tracker(usage, user_id, name)
 
     # Get budget for users
-    user_budget = get_user_budget(config, user_id)
+    user_budget = await get_user_budget(config, user_id)
     budget_period = config['budget_period']
     if user_budget is not None:
         cost = usage[user_id].get_current_cost()[budget_cost_map[budget_period]]
         return user_budget - cost
 
     # Get budget for guests
-    if 'guests' not in usage:
-        usage['guests'] = UsageTracker('guests', 'all guest users in group chats')
+    await get_usage_tracker(usage, 'guests', 'all guest users in group chats')
     cost = usage['guests'].get_current_cost()[budget_cost_map[budget_period]]
     return config['guest_budget'] - cost
 
 
-def is_within_budget(config, usage, update: Update, is_inline=False) -> bool:
+async def is_within_budget(config, usage, update: Update, is_inline=False) -> bool:
     """
     Проверяет, достиг ли пользователь лимита использования.
     При необходимости инициализирует UsageTracker для пользователя и гостя.
@@ -274,9 +484,8 @@ def is_within_budget(config, usage, update: Update, is_inline=False) -> bool:
     """
     user_id = update.inline_query.from_user.id if is_inline else update.message.from_user.id
     name = update.inline_query.from_user.name if is_inline else update.message.from_user.name
-    if user_id not in usage:
-        usage[user_id] = UsageTracker(user_id, name)
-    remaining_budget = get_remaining_budget(config, usage, update, is_inline=is_inline)
+    await get_usage_tracker(usage, user_id, name)
+    remaining_budget = await get_remaining_budget(config, usage, update, is_inline=is_inline)
     return remaining_budget > 0
 
 
@@ -295,8 +504,7 @@ def add_chat_request_to_usage_tracker(usage, config, user_id, used_tokens):
         # добавить запрос чата в трекер использования пользователей
         usage[user_id].add_chat_tokens(used_tokens, config['token_price'])
         # добавить запрос чата гостя в трекер использования гостей
-        allowed_user_ids = config['allowed_user_ids'].split(',')
-        if str(user_id) not in allowed_user_ids and 'guests' in usage:
+        if config['access_policy'].is_guest(user_id) and 'guests' in usage:
             usage["guests"].add_chat_tokens(used_tokens, config['token_price'])
     except Exception as e:
         logging.warning(f'Не удалось добавить токены в Usage_logs: {str(e)}')
@@ -331,9 +539,13 @@ def is_direct_result(response: any) -> bool:
         return response.get('direct_result', False)
 
 
-async def handle_direct_result(config, update: Update, response: any):
+async def handle_direct_result(config, update: Update, response: any, direct_result_cache=None):
     """
-    Handles a direct result from a plugin
+    Handles a direct result from a plugin. Its 'format' is a 'url', a Telegram 'file_id', a local file 'path',
+    which is deleted once sent, or 'bytes', content in memory as bytes or a binary buffer with an optional
+    'filename'. If the result has a 'cache_key', the Telegram file_id of its upload is kept in the direct
+    result cache, so that the plugin can send it again by reference. If Telegram no longer accepts
+    a cached file_id, the entry is dropped and the result is generated again with its 'regenerate' callback.
     """
     if type(response) is not dict:
         response = json.loads(response)
@@ -342,32 +554,69 @@ async def handle_direct_result(config, update: Update, response: any):
     kind = result['kind']
     format = result['format']
     value = result['value']
+    key = result.get('cache_key')
 
     common_args = {
         'message_thread_id': get_thread_id(update),
         'reply_to_message_id': get_reply_to_message_id(config, update),
     }
 
-    if kind == 'photo':
-        if format == 'url':
-            await update.effective_message.reply_photo(**common_args, photo=value)
-        elif format == 'path':
-            await update.effective_message.reply_photo(**common_args, photo=open(value, 'rb'))
-    elif kind == 'gif' or kind == 'file':
-        if format == 'url':
-            await update.effective_message.reply_document(**common_args, document=value)
-        if format == 'path':
-            await update.effective_message.reply_document(**common_args, document=open(value, 'rb'))
-    elif kind == 'dice':
-        await update.effective_message.reply_dice(**common_args, emoji=value)
-
-    if format == 'path':
+    try:
+        message = None
+        if kind == 'photo':
+            if format == 'url' or format == 'file_id':
+                message = await update.effective_message.reply_photo(**common_args, photo=value)
+            elif format == 'bytes':
+                message = await update.effective_message.reply_photo(**common_args, photo=value,
+                                                                     filename=result.get('filename'))
+            elif format == 'path':
+                with open(value, 'rb') as file:
+                    message = await update.effective_message.reply_photo(**common_args, photo=file)
+        elif kind == 'gif' or kind == 'file':
+            if format == 'url' or format == 'file_id':
+                message = await update.effective_message.reply_document(**common_args, document=value)
+            elif format == 'bytes':
+                message = await update.effective_message.reply_document(**common_args, document=value,
+                                                                        filename=result.get('filename'))
+            elif format == 'path':
+                with open(value, 'rb') as file:
+                    message = await update.effective_message.reply_document(**common_args, document=file)
+        elif kind == 'dice':
+            await update.effective_message.reply_dice(**common_args, emoji=value)
+    except telegram.error.BadRequest as e:
+        if format != 'file_id' or direct_result_cache is None:
+            raise
+        # the file is no longer available by its file_id, the plugin runs again without the cached entry
+        logging.warning(f'Cached file of a direct result was rejected: {str(e)}. Generating it again...')
+        direct_result_cache.delete(key)
+        if 'regenerate' not in result:
+            raise
+        regenerated = await result['regenerate']()
+        if not is_direct_result(regenerated):
+            raise
+        return await handle_direct_result(config, update, regenerated, direct_result_cache)
+    finally:
         cleanup_intermediate_files(response)
 
+    if key is not None and format != 'file_id' and message is not None and direct_result_cache is not None:
+        file_id = sent_file_id(message)
+        if file_id is not None:
+            direct_result_cache.put(key, file_id, ttl=result.get('cache_ttl'))
+
+
+def sent_file_id(message: Message) -> str | None:
+    """
+    Gets the Telegram file_id of the file attached to a sent message, the largest size of a photo.
+    """
+    attachment = message.effective_attachment
+    if isinstance(attachment, (list, tuple)):
+        attachment = attachment[-1] if attachment else None
+    return getattr(attachment, 'file_id', None)
+
 
 def cleanup_intermediate_files(response: any):
     """
-    Deletes intermediate files created by plugins
+    Deletes intermediate files created by plugins, and closes the buffers of in-memory direct results
     """
     if type(response) is not dict:
         response = json.loads(response)
@@ -379,13 +628,82 @@ def cleanup_intermediate_files(response: any):
     if format == 'path':
         if os.path.exists(value):
             os.remove(value)
+    elif format == 'bytes' and hasattr(value, 'close'):
+        value.close()
+
+
+# Thread pool for image processing, so that PIL and base64 never block the event loop
+image_executor = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1), thread_name_prefix='image')
+
+# Largest image size the vision models process without downscaling it themselves
+# https://platform.openai.com/docs/guides/vision
+VISION_LOW_DETAIL_SIZE = 512
+VISION_HIGH_DETAIL_SIZE = 2048
+VISION_HIGH_DETAIL_SHORT_SIDE = 768
+
+
+async def run_in_image_executor(func, *args):
+    """
+    Runs an image processing function in the image thread pool.
+    """
+    return await asyncio.get_running_loop().run_in_executor(image_executor, func, *args)
+
+
+def prepare_vision_image(fileobj, detail: str, image_format: str = 'jpeg', quality: int = 85) -> io.BytesIO:
+    """
+    Downscales an image to the size the vision model works with for the given detail
+    and re-encodes it, so that less is uploaded and billed.
+    :param fileobj: The image file
+    :param detail: The vision detail, 'low', 'high' or 'auto'
+    :param image_format: The format to encode the image with, 'jpeg' or 'webp'
+    :param quality: The encoding quality
+    :return: The re-encoded image
+    """
+    with Image.open(fileobj) as image:
+        image.load()
+        if detail == 'low':
+            image.thumbnail((VISION_LOW_DETAIL_SIZE, VISION_LOW_DETAIL_SIZE), Image.LANCZOS)
+        else:
+            image.thumbnail((VISION_HIGH_DETAIL_SIZE, VISION_HIGH_DETAIL_SIZE), Image.LANCZOS)
+            scale = VISION_HIGH_DETAIL_SHORT_SIDE / min(image.size)
+            if scale < 1:
+                image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))),
+                                     Image.LANCZOS)
+
+        if image_format == 'jpeg' and image.mode != 'RGB':
+            # JPEG has no alpha channel, transparent parts become white
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        elif image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA')
+
+        output = io.BytesIO()
+        image.save(output, format=image_format.upper(), quality=quality)
+    output.seek(0)
+    return output
+
+
+def image_mime_type(data: bytes) -> str:
+    """
+    Gets the MIME type of an image from its first bytes.
+    """
+    if data.startswith(b'\x89PNG'):
+        return 'image/png'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    if data.startswith(b'GIF8'):
+        return 'image/gif'
+    return 'image/jpeg'
 
 
 # Function to encode the image
 def encode_image(fileobj):
-    image = base64.b64encode(fileobj.getvalue()).decode('utf-8')
-    return f'data:image/jpeg;base64,{image}'
+    data = fileobj.getvalue()
+    image = base64.b64encode(data).decode('utf-8')
+    return f'data:{image_mime_type(data)};base64,{image}'
 
 def decode_image(imgbase64):
-    image = imgbase64[len('data:image/jpeg;base64,'):]
+    image = imgbase64.split(',', 1)[1]
     return base64.b64decode(image)